@@ -46,6 +46,10 @@ echo "setup experiment hosts..."
 { pos commands launch --quiet --infile dut/setup.sh --blocking "$2"; } &
 wait
 
+echo "deploy steady state detection..."
+pos nodes copy "$1" loadgen/steady_state.py --dest /root/
+pos nodes copy "$1" ../plot_scripts/util/moongen.py --dest /root/
+
 echo "execute experiment on hosts..."
 { pos commands launch --quiet --infile loadgen/measurement.sh --blocking --loop "$1"; } &
 { pos commands launch --quiet --infile dut/measurement.sh --blocking --loop "$2"; } &
@@ -37,11 +37,22 @@ pos_sync
 
 pos_run --loop loadgen -- bash -c "$MOONGEN_DIR/build/MoonGen $MOONGEN_DIR/examples/soft-gen.lua --src-mac $LOADGEN_EGRESS_MAC --dst-mac $DUT_INGRESS_MAC --src-ip $LOADGEN_EGRESS_IP --dst-ip $LOADGEN_INGRESS_IP --fix-packetrate $PKT_RATE --size $PKT_SZ --packets $PKTS_TOTAL --chksum-offload $LOADGEN_ENABLE_OFFLOAD --ip-chksum $LOADGEN_ENABLE_IP_SW_CHKSUM_CALC --warm-up $LOADGEN_WARM_UP $LOADGEN_EGRESS_DEV $LOADGEN_INGRESS_DEV > /root/throughput.log"
 
-sleep 50
+# stop as soon as the throughput converged, at the latest after 50s
+# falls back to waiting if the helper is missing or fails, e.g. on an image without its dependencies
+if [ -f /root/steady_state.py ]; then
+	python3 /root/steady_state.py /root/throughput.log --timeout 50 || sleep 50
+else
+	sleep 50
+fi
 
 pos_kill --loop loadgen
 
-sleep 100
+# wait for the summary of MoonGen, at the latest 100s
+if [ -f /root/steady_state.py ]; then
+	python3 /root/steady_state.py /root/throughput.log --wait-summary --timeout 100 || sleep 100
+else
+	sleep 100
+fi
 
 pos_upload --loop /root/throughput.log
 
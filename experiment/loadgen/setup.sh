@@ -32,4 +32,7 @@ git checkout "$MOONGEN_REPO_COMMIT"
 "$MOONGEN_DIR"/bind-interfaces.sh
 "$MOONGEN_DIR"/setup-hugetlbfs.sh
 
+# steady state detection during the measurement
+apt-get install -y python3-numpy
+
 echo "setup successful"
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+# Script is run locally on experiment server.
+#
+# Waits until the MoonGen stdout of the current loop point reached a steady state and its mean converged,
+# so that the measurement can be stopped early. Uses the same detector as plot_scripts/plot_throughput.py,
+# moongen.py from plot_scripts/util must be copied next to this script.
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'plot_scripts', 'util'))
+from moongen import (MOONGEN_DATA_OUTPUT, STEADY_STATE, TOTAL, get_devices, new_follow_state, follow_moongen_stdout,
+                     is_finished, add_steady_state, add_statistics)
+
+
+def follow(logfile, state):
+    # only the lines appended since the last call are parsed
+    try:
+        follow_moongen_stdout(logfile, state)
+    except FileNotFoundError:
+        pass
+    return state
+
+
+def print_statistics(run):
+    add_statistics(run, 0)
+    for cid, direction in get_devices(run):
+        if (cid, direction, 'avg_mpps') in run:
+            print('[Device: id={}] {}: {}'.format(cid, direction.upper(), ', '.join(
+                '{:.2f} {}'.format(run[(cid, direction, 'avg_' + item)], item) for item in MOONGEN_DATA_OUTPUT)))
+
+
+def wait_for_steady_state(args):
+    start = time.monotonic()
+    state = new_follow_state()
+    while time.monotonic() - start < args.timeout:
+        time.sleep(args.interval)
+        follow(args.logfile, state)
+        if not ('rx' in state['valid_file'] and 'tx' in state['valid_file']):
+            continue
+        if time.monotonic() - start < args.min_duration:
+            continue
+        run = dict(state['run'])
+        add_steady_state(run, window=args.window, tolerance=args.tolerance,
+                         confidence=args.confidence, precision=args.precision)
+        converged = run[TOTAL + ('steady_converged',)]
+        if converged == converged:
+            print('steady state reached, mean converged after {:g}s'.format(converged))
+            print_statistics(run)
+            return
+    print('no steady state within {:g}s'.format(args.timeout))
+
+
+def wait_for_summary(args):
+    # MoonGen prints the summary when it is stopped
+    start = time.monotonic()
+    state = new_follow_state()
+    while time.monotonic() - start < args.timeout:
+        if is_finished(follow(args.logfile, state)):
+            print('summary written after {:.0f}s'.format(time.monotonic() - start))
+            return
+        time.sleep(args.interval)
+    print('no summary within {:g}s'.format(args.timeout))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Wait until a MoonGen measurement is in steady state')
+    parser.add_argument('logfile', metavar='LOGFILE', type=str,
+                        help='MoonGen stdout of the running measurement')
+    parser.add_argument('--timeout', type=float, default=50,
+                        help='seconds after which to stop waiting in any case')
+    parser.add_argument('--min-duration', type=float, default=0,
+                        help='seconds to wait at least')
+    parser.add_argument('--interval', type=float, default=1,
+                        help='seconds between reading the log file')
+    parser.add_argument('--wait-summary', action='store_true',
+                        help='wait until MoonGen printed its summary instead')
+    parser.add_argument('--window', type=int, default=STEADY_STATE['window'],
+                        help='seconds that must be within the tolerance to count as steady state')
+    parser.add_argument('--tolerance', type=float, default=STEADY_STATE['tolerance'],
+                        help='relative spread allowed within the steady state window')
+    parser.add_argument('--confidence', type=float, default=STEADY_STATE['confidence'],
+                        help='confidence level for the convergence of the mean')
+    parser.add_argument('--precision', type=float, default=STEADY_STATE['precision'],
+                        help='relative half width of the confidence interval')
+    args = parser.parse_args()
+
+    # never fail the measurement, the timeout is the old fixed duration
+    if args.wait_summary:
+        wait_for_summary(args)
+    else:
+        wait_for_steady_state(args)
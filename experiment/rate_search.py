@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+# Script is run on the pos management host.
+#
+# Searches the maximum lossless packet rate per packet size (RFC 2544 style) instead of sweeping the whole
+# pkt_rate x pkt_sz cross product of loop-variables.yml. Every round reads the results measured so far and
+# writes the loop variables of the next round, one file per group of packet sizes sharing the same rates:
+#
+#   rate_search.py plan loop-variables.yml RESULT_DIR [RESULT_DIR ...] --output next/
+#
+# The search can be tested offline against a simulated DUT replaying recorded results:
+#
+#   rate_search.py simulate ../results/2020-10-12_11-20-32_230471/config/allocation.json \
+#       ../results/2020-10-12_11-20-32_230471/vriga
+
+import os
+import re
+import sys
+import json
+import argparse
+from glob import glob
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plot_scripts'))
+from util.cache import cached, encode_run, decode_run
+from util.loop_plot import read_loopfile
+from util.moongen import TOTAL, ParsingError, read_moongen_summary, add_statistics
+
+
+# loop variables as used by pos, e.g. pkt_rate: [10000, 20000, ..., 300000]
+def expand_range(values):
+    if len(values) == 4 and values[2] == '...':
+        start, second, _, stop = values
+        return list(range(start, stop + 1, second - start))
+    return values
+
+def read_loop_variables(path):
+    # either a loop-variables.yml or the config/allocation.json of a finished experiment
+    if path.endswith('.json'):
+        with open(path) as infile:
+            return json.load(infile)['variables']['loop']
+    variables = {}
+    with open(path) as infile:
+        for line in infile:
+            match = re.match(r'\s*(\w+)\s*:\s*\[(.*)\]', line)
+            if match:
+                values = [value.strip() for value in match.group(2).split(',')]
+                variables[match.group(1)] = expand_range([value if value == '...' else int(value) for value in values])
+    return variables
+
+def write_loop_variables(path, variables):
+    with open(path, 'w') as outfile:
+        for key, values in variables.items():
+            outfile.write('{}: [{}]\n'.format(key, ', '.join(str(value) for value in values)))
+
+
+def read_results(paths, throughput_file='throughput_run*.log', loop_file='*_run*.loop'):
+    # loss ratios of all measured (pkt_sz, pkt_rate) points, runs are matched by their run number
+    results = {}
+    for path in paths:
+        logs = {exp.split('_run')[-1].split('.')[0]: exp for exp in glob(os.path.join(path, throughput_file))}
+        for loop in sorted(glob(os.path.join(path, loop_file))):
+            run = loop.split('_run')[-1].split('.')[0]
+            if run not in logs:
+                continue
+            try:
+                tp = cached(logs[run], 'summary', lambda: read_moongen_summary(logs[run]), encode_run, decode_run)
+            except ParsingError as exce:
+                print('Skipping {} - {}'.format(logs[run], exce), file=sys.stderr)
+                continue
+            loss = add_statistics(tp, 0).get(TOTAL + ('loss_ratio',))
+            if loss is None:
+                continue
+            variables = read_loopfile(loop)
+            point = (variables['pkt_sz'], variables['pkt_rate'])
+            results[point] = results.get(point, []) + [loss]
+    return results
+
+
+def find_bounds(rates, lossless):
+    # index of the highest lossless rate below the lowest rate with loss, -1 and len(rates) if unknown
+    hi = min([i for i, rate in enumerate(rates) if lossless.get(rate) is False], default=len(rates))
+    lo = max([i for i, rate in enumerate(rates) if lossless.get(rate) and i < hi], default=-1)
+    return lo, hi
+
+def next_rates(rates, lossless, points=1):
+    # start at the highest rate, then split the remaining interval into points + 1 parts
+    lo, hi = find_bounds(rates, lossless)
+    if hi - lo <= 1:
+        return []
+    if not lossless:
+        return [rates[-1]]
+    indices = {lo + (hi - lo) * (i + 1) // (points + 1) for i in range(points)}
+    return [rates[i] for i in sorted(indices) if lo < i < hi]
+
+def plan(variables, results, loss_tolerance=0.001, points=1):
+    # returns the maximum lossless rate found so far and the rates that still need to be measured
+    status = {}
+    for pkt_sz in variables['pkt_sz']:
+        lossless = {rate: max(results[(pkt_sz, rate)]) <= loss_tolerance
+                    for rate in variables['pkt_rate'] if (pkt_sz, rate) in results}
+        lo, _ = find_bounds(variables['pkt_rate'], lossless)
+        status[pkt_sz] = {
+            'max_lossless': variables['pkt_rate'][lo] if lo >= 0 else None,
+            'measured'    : len(lossless),
+            'next'        : next_rates(variables['pkt_rate'], lossless, points),
+        }
+    return status
+
+def group_next_rates(status):
+    # packet sizes with the same next rates share one loop variables file, pos uses the cross product
+    groups = {}
+    for pkt_sz, size_status in status.items():
+        if size_status['next']:
+            groups.setdefault(tuple(size_status['next']), []).append(pkt_sz)
+    return [{'pkt_sz': pkt_sizes, 'pkt_rate': list(rates)} for rates, pkt_sizes in groups.items()]
+
+
+def print_status(status):
+    for pkt_sz, size_status in status.items():
+        print('pkt_sz {:5d}: max lossless {}, {} measured, next {}'.format(
+            pkt_sz, size_status['max_lossless'], size_status['measured'], size_status['next'] or 'done'))
+
+def run_plan(args):
+    variables = read_loop_variables(args.loop_variables)
+    status = plan(variables, read_results(args.results, args.throughput_filename, args.loop_filename),
+                  args.loss_tolerance, args.points_per_round)
+    print_status(status)
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+        for old in glob(os.path.join(args.output, 'loop-variables-*.yml')):
+            os.remove(old)
+        for i, group in enumerate(group_next_rates(status)):
+            path = os.path.join(args.output, 'loop-variables-{:03d}.yml'.format(i))
+            write_loop_variables(path, group)
+            print('Generated ' + path)
+
+def run_simulation(args):
+    # the simulated DUT answers with the recorded loss of the same loop point
+    variables = read_loop_variables(args.loop_variables)
+    recorded = read_results(args.results, args.throughput_filename, args.loop_filename)
+    measured = {}
+    rounds = 0
+    while True:
+        status = plan(variables, measured, args.loss_tolerance, args.points_per_round)
+        groups = group_next_rates(status)
+        if not groups:
+            break
+        rounds += 1
+        for group in groups:
+            for point in [(pkt_sz, rate) for pkt_sz in group['pkt_sz'] for rate in group['pkt_rate']]:
+                if point not in recorded:
+                    raise RuntimeError('No recorded run for pkt_sz {} and pkt_rate {}'.format(*point))
+                measured[point] = recorded[point]
+
+    print_status(status)
+    exhaustive = plan(variables, recorded, args.loss_tolerance, args.points_per_round)
+    for pkt_sz, size_status in exhaustive.items():
+        if not size_status['max_lossless'] == status[pkt_sz]['max_lossless']:
+            print('pkt_sz {:5d}: exhaustive sweep finds {} (non-monotonic loss)'.format(
+                pkt_sz, size_status['max_lossless']))
+    print('{} rounds, {} of {} loop points measured'.format(
+        rounds, len(measured), len(variables['pkt_sz']) * len(variables['pkt_rate'])))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Search the maximum lossless packet rate per packet size')
+    parser.add_argument('mode', metavar='MODE', choices=['plan', 'simulate'],
+                        help='plan the next round or simulate the whole search with recorded results')
+    parser.add_argument('loop_variables', metavar='LOOP_VARIABLES', type=str,
+                        help='loop-variables.yml or config/allocation.json with the pkt_sz and pkt_rate candidates')
+    parser.add_argument('results', metavar='RESULT_DIR', type=str, nargs='*',
+                        help='result directories of the loadgen containing throughput logs and loop files')
+    parser.add_argument('--output', metavar='OUTPUT_DIR', type=str,
+                        help='directory for the loop variables of the next round')
+    parser.add_argument('--loss-tolerance', metavar='RATIO', type=float, default=0.001,
+                        help='packet loss ratio that still counts as lossless')
+    parser.add_argument('--points-per-round', metavar='POINTS', type=int, default=1,
+                        help='rates measured per packet size and round, 1 is a binary search')
+    parser.add_argument('--throughput-filename', metavar='TP_FILENAME', type=str, default='throughput_run*.log',
+                        help='name of the throughput data files, wildcard possible')
+    parser.add_argument('--loop-filename', metavar='LOOP_FILENAME', type=str, default='*_run*.loop',
+                        help='name of the loop variable files, wildcard possible')
+    args = parser.parse_args()
+
+    if args.mode == 'plan':
+        run_plan(args)
+    else:
+        run_simulation(args)
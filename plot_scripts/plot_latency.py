@@ -22,14 +22,34 @@
 # 
 # ### Features
 # * histogram, normalized histogram, CDF and HDR generation
+#  * histograms are drawn as one step line per experiment, exported as pgfplots const plot
 # * optinal sequence plot generation
+#  * sequence files are streamed in blocks, only the minimum and maximum latency per bucket are plotted
+#  * --sequence-mode envelope or density for min/median/max envelopes or a density image (data/*.png)
+# * loop plots of percentiles, repeated runs are averaged with bootstrap confidence intervals as error bands
+#  * loop_facets=True for one faceted figure (pgfplots groupplot) of all groups instead of one figure per group
 # * figures created in figures/*.tex
+#  * written as pgfplots straight from the data, --tex-backend tikzplotlib to convert matplotlib figures instead
+#  * matplotlib only draws the figure for additional exports (e.g. svg) and previews in notebooks
+#  * figures whose data did not change are not written again (figures/.manifest.json), --no-figure-cache to force
+#  * --list-stale and --prune-stale for files written for figures that no figure writes anymore, e.g. of another backend
+#  * independent figures are written in parallel by --render-processes forked processes, each file is written atomically
 # * externalized data into data/*.tsv
 # * TUMcolors supported
 # * makefile to generate pdfs
 # * same structure as expected by I8 thesis template
 # * latency is converted to microsecond
-# * histogram data is binned to microsecond resolution
+# * histogram data is binned to microsecond resolution (exact integer bins of the nanosecond values)
+#  * a pyramid of 10, 100, 1000 and 10000 ns bins is cached per run, rebin_hist_data changes the binning in place
+#  * hist, cdf, hdr, ... of a run are only computed when a plot needs them, --view-budget limits their memory
+# * histograms are kept as sorted value and count arrays, plot functions also accept {value: occurence} dicts
+# * percentiles and box plots are computed from the histogram, without one value per packet in memory
+# * HDR from a log bucketed histogram (--significant-digits), --aggregate merges all matches of a path into one
+# * hardware timestamped pcap/pcapng captures instead of csv files, e.g. --histogram-filename '*rx.pcap'
+#  * TX and RX packets (name with tx instead of rx) are matched by a field of the packet (--pcap-field-*)
+#  * or --pcap-timestamp if the field is the TX timestamp in ns, captures are parsed in blocks of whole arrays
+#  * TX and RX are matched block by block, memory is bounded by a few blocks instead of the size of the captures
+# * parsed files are cached in .plot-cache next to the data, --no-cache to parse them again
 # 
 # ## You should not have to edit any of the following cells besides the last one
 # * However you might want to tweak some plots manually
@@ -37,9 +57,9 @@
 # ## errors
 # * if you get tex capacity exceeded when trying to compile the figures you have too many data points
 #  * solution: less bins, by rounding more (e.g. 10 or 100 microsecond resolution)
-#  * change: in to_microsecond change the dividend (from 1000 to 10000 or 100000)
+#  * change: lower --round-ms-digits (e.g. 2 or 1) or --sequence-buckets for the sequence plot
 #  * result: not microsecond resolution/bins but 10 or 100 microsecond
-#  * dont forget to either update all axis labels or convert back to microsecond after binning
+#  * otherwise lines are decimated to at most --max-points per figure, keeping the minimum and maximum of each bucket
 
 # In[ ]:
 
@@ -48,9 +68,7 @@ import os
 import sys
 import math
 import json
-import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
-import numpy as np
 from glob import glob
 rprint=print
 from pprint import pprint as print
@@ -62,9 +80,19 @@ from pprint import pprint as print
 # import other utility notebooks
 import import_ipynb
 # NOTE: tumcolors only work with python 3.6 and newer
-from util.tumcolor import tumcolor_cycler
-from util.i8_tikzplotlib import get_tikz_code, save_plt
-from util.loop_plot import _plot_loop
+from util.tumcolor import tumcolor_cmap
+from util.i8_tikzplotlib import get_tikz_code, configure_tikz
+from util.loop_plot import _plot_loop, plot_loop_series, save_loop_plot
+from util.figure import (Figure, FIGURE_BACKENDS, configure_figures, print_figure_stats, stale_artifacts,
+                         prune_artifacts, figure_pool)
+from util.bootstrap import DEFAULT_CONFIDENCE
+from util.cache import configure_cache, print_cache_stats, cached
+from util.histogram import (HDR_SIGNIFICANT_DIGITS, BinPyramid, LogHistogram, read_histogram, to_histogram,
+                            encode_pyramid, decode_pyramid, encode_log_histogram, decode_log_histogram)
+from util.lazy import LazyRecord, configure_views, print_view_stats
+from util.sequence import SEQUENCE_BUCKETS, read_sequence, to_sequence, encode_sequence, decode_sequence
+from util.pcap import (PCAP_FIELD, is_capture, capture_files, capture_kind, filter_captures,
+                       read_capture_histogram, read_capture_sequence)
 
 
 # In[ ]:
@@ -81,6 +109,10 @@ def run_from_cli():
                         help='name of the histogram data file, wildcard possible')
     parser.add_argument('--sequence-filename', metavar='SEQ_FILENAME', type=str, default='',
                         help='name of the sequence data file, wildcard possible')
+    parser.add_argument('--sequence-buckets', metavar='BUCKETS', type=int, default=SEQUENCE_BUCKETS,
+                        help='sequence data is reduced to the minimum and maximum latency of this many buckets')
+    parser.add_argument('--sequence-mode', choices=['points', 'envelope', 'density'], default='points',
+                        help='plot the minimum and maximum points, min/median/max envelopes or a density image')
     parser.add_argument('--name', type=str, default='',
                         help='suffix for output files, e.g. hdr-NAME.tex')
     parser.add_argument('path', metavar='PATH', type=str, nargs='+',
@@ -91,6 +123,37 @@ def run_from_cli():
                         help='Round to ROUND ms digits for binning')
     parser.add_argument('--histogram-bar-width', metavar='BAR_WIDTH', type=float, default=0.005,
                         help='Width for histogram bars')
+    parser.add_argument('--aggregate', action='store_true',
+                        help='merge all histogram files matching HIST_FILENAME of a path into one histogram')
+    parser.add_argument('--significant-digits', metavar='DIGITS', type=int, default=HDR_SIGNIFICANT_DIGITS,
+                        help='significant digits of the log bucketed histogram used for the HDR and for aggregating')
+    parser.add_argument('--pcap-field-offset', metavar='OFFSET', type=int, default=PCAP_FIELD['offset'],
+                        help='byte offset of the field matching TX and RX packets of pcap captures, matched in blocks '
+                             'of 64 MiB, packets reordered by more than a block count as lost')
+    parser.add_argument('--pcap-field-size', metavar='SIZE', type=int, default=PCAP_FIELD['size'],
+                        help='size of the field in bytes')
+    parser.add_argument('--pcap-field-byteorder', choices=['big', 'little'], default=PCAP_FIELD['byteorder'],
+                        help='byte order of the field')
+    parser.add_argument('--pcap-timestamp', action='store_true',
+                        help='the field is the TX timestamp in ns, no TX capture is needed')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='parse all files again instead of using the cache next to them')
+    parser.add_argument('--cache-size', metavar='CACHE_SIZE', type=int, default=256,
+                        help='maximum size of the cache per directory in MiB, least recently used entries are evicted')
+    parser.add_argument('--view-budget', metavar='VIEW_BUDGET', type=int, default=512,
+                        help='memory in MiB for derived views (hist, cdf, ...) of all runs, least recently used are released')
+    parser.add_argument('--max-points', metavar='MAX_POINTS', type=int, default=20000,
+                        help='maximum number of points of all lines of a figure, lines are decimated to their minima and maxima')
+    parser.add_argument('--tex-backend', choices=FIGURE_BACKENDS, default='pgfplots',
+                        help='write figures as pgfplots straight from the data or convert matplotlib figures with tikzplotlib')
+    parser.add_argument('--no-figure-cache', action='store_true',
+                        help='write all figures again, even if their data did not change since the last run')
+    parser.add_argument('--render-processes', metavar='RENDER_PROCESSES', type=int, default=None,
+                        help='processes writing the figures in parallel, at most one per figure, default is one per cpu')
+    parser.add_argument('--list-stale', action='store_true',
+                        help='list files once written for a figure in figures/ and data/ that no figure writes anymore')
+    parser.add_argument('--prune-stale', action='store_true',
+                        help='remove these files after plotting')
 
     args = parser.parse_args()
     if args.label and not len(args.label) == len(args.path):
@@ -102,14 +165,33 @@ def run_from_cli():
     else:
         experiments = args.path
         
-    plot(experiments,
-         basepath=args.basepath,
-         histogram_file=args.histogram_filename,
-         sequence_file=args.sequence_filename,
-         name=args.name,
-         round_ms_digits=args.round_ms_digits,
-         histogram_bar_width=args.histogram_bar_width,
-    )
+    configure_cache(enabled=not args.no_cache, max_size=args.cache_size * 1024 * 1024)
+    configure_views(max_size=args.view_budget * 1024 * 1024)
+    configure_tikz(max_points=args.max_points)
+    configure_figures(backend=args.tex_backend, cache=not args.no_figure_cache)
+    with figure_pool(args.render_processes):
+        plot(experiments,
+             basepath=args.basepath,
+             histogram_file=args.histogram_filename,
+             sequence_file=args.sequence_filename,
+             name=args.name,
+             round_ms_digits=args.round_ms_digits,
+             historgram_bar_width=args.histogram_bar_width,
+             aggregate=args.aggregate,
+             significant_digits=args.significant_digits,
+             sequence_buckets=args.sequence_buckets,
+             sequence_mode=args.sequence_mode,
+             pcap_field={'offset': args.pcap_field_offset, 'size': args.pcap_field_size,
+                         'byteorder': args.pcap_field_byteorder, 'timestamp': args.pcap_timestamp},
+        )
+    print_cache_stats()
+    print_figure_stats()
+    if args.list_stale:
+        for path in stale_artifacts():
+            rprint(path)
+    if args.prune_stale:
+        prune_artifacts()
+    print_view_stats()
         
     sys.exit()
 
@@ -117,67 +199,45 @@ def run_from_cli():
 # In[ ]:
 
 
-def read_2c_csv(exp):
-    data = dict()
-    with open(exp) as infile:
-        for line in infile:
-            lat, occ = line.strip().split(',')
-            data[int(lat)] = int(occ)
-    return data
+def to_ns_bin_width(round_ms_digits=3):
+    # rounding to ROUND microsecond digits as exact integer bins of the nanosecond values
+    return 10 ** max(0, 3 - round_ms_digits)
 
 
 # In[ ]:
 
 
-def to_microsecond(data, keys=True, values=False):
-    if keys and values:
-        return {k / 1000: v / 1000 for k, v in data.items()}
-    if keys:
-        return {k / 1000: v for k, v in data.items()}
-    if values:
-        return {k: v / 1000 for k, v in data.items()}
-    
-def to_ms_bins(data, round_ms_digits=3):
-    binned = {}
-    for k, v in data.items():
-        rounded = round(k, round_ms_digits)
-        if rounded not in binned:
-            binned[rounded] = v
-        else:
-            binned[rounded] += v
-    return binned
-
-def to_expanded(data):
-    expanded = []
-    for val, occ in data.items():
-        expanded += [val] * occ
-    return expanded
-
-def normalize(data):
-    total = sum(data.values())
-    percs = {k: (v/total) for k, v in data.items()}
-    return percs
-
-def accumulate(data):
-    global curr
-    curr = 0
-    def acc(val): # just for the list comprehension
-        global curr
-        curr += val
-        return curr
-    return {k: acc(v) for k, v in sorted(data.items())}
-    
-def to_hdr(data):
-    # treat negative (>1.0) and exact 1.0 values and very high values for v
-    MAX_ACCURACY = 1000000000
-    return {k: 1/(1-v) for k, v in data.items() if not (1-v) == 0.0 and not 1/(1-v) < 0 and not 1/(1-v) > MAX_ACCURACY}
-
-
-# In[ ]:
+# derived views of a run, computed on first access from the pyramid, or the log histogram if aggregated
+HIST_VIEWS = {
+    'log'      : lambda run: LogHistogram.from_histogram(run['pyramid'].raw, run['significant_digits']).to_unit(1000),
+    'hist'     : lambda run: run['pyramid'].rebin(to_ns_bin_width(run['round_ms_digits'])).to_unit(1000),
+    'hist_norm': lambda run: run['hist'].normalize(),
+    'cdf'      : lambda run: run['hist'].cdf(),
+    'hdr'      : lambda run: run['log'].hdr(),
+    'box'      : lambda run: run['pyramid'].raw.to_unit(1000),
+}
+
+def rebin_hist_data(data, round_ms_digits=3):
+    # e.g. to tune ROUND_MS_DIGITS in the notebook without reading the files again
+    for run in data.values():
+        run['round_ms_digits'] = round_ms_digits
+        run.release('hist', 'hist_norm', 'cdf')
+    return data
 
+def process_hist_data(pyramid, log_data=None, round_ms_digits=3, significant_digits=HDR_SIGNIFICANT_DIGITS):
+    # nothing is computed until a plot needs it, a given log histogram is kept instead of the view
+    run = LazyRecord(HIST_VIEWS, {
+        'pyramid'           : pyramid,
+        'round_ms_digits'   : round_ms_digits,
+        'significant_digits': significant_digits,
+    })
+    if log_data is not None:
+        run['log'] = log_data.to_unit(1000)
+    return run
 
 def extract_hist_data(paths, basepath='/', histogram_file='histogram.csv', round_ms_digits=3,
-                      progression_mapping_function=None):
+                      progression_mapping_function=None, aggregate=False,
+                      significant_digits=HDR_SIGNIFICANT_DIGITS, pcap_field=PCAP_FIELD):
     data = {}
     if not isinstance(paths, list):
         paths = [paths]
@@ -194,12 +254,15 @@ def extract_hist_data(paths, basepath='/', histogram_file='histogram.csv', round
         experiment = os.path.join(extended_path, histogram_file)
         rprint('Processing ' + extended_path)
         
-        subexperiments = glob(experiment)
+        subexperiments = filter_captures(glob(experiment), pcap_field)
         update_name = False
         base_name = name
-        if len(subexperiments) > 1:
+        if len(subexperiments) > 1 and not aggregate:
             update_name = True
         
+        # all matches of the path merged into one histogram, e.g. repeated runs or several loadgen nodes
+        merged = None
+        aggregated = 0
         for exp in subexperiments:
             # replace everything that is not wildcard
             if not (basepath == '.' or basepath == '..'):
@@ -213,35 +276,49 @@ def extract_hist_data(paths, basepath='/', histogram_file='histogram.csv', round
             if update_name:
                 name = base_name + histo
                 
-            # load data
+            # load data, captures depend on their TX capture and the matched field as well
+            files, kind, read = exp, '', lambda: read_histogram(exp)
+            if is_capture(exp):
+                files, kind = capture_files(exp, pcap_field), '-' + capture_kind(pcap_field)
+                read = lambda: read_capture_histogram(exp, pcap_field)
             try:
-                raw_data = read_2c_csv(exp)
+                if aggregate:
+                    log_data = cached(files, 'log{}{}'.format(significant_digits, kind),
+                                      lambda: LogHistogram.from_histogram(read(), significant_digits),
+                                      encode_log_histogram, decode_log_histogram)
+                else:
+                    raw_data = cached(files, 'pyramid' + kind, lambda: BinPyramid.from_histogram(read()),
+                                      encode_pyramid, decode_pyramid)
             except FileNotFoundError as exce:
                 rprint('Skipping - {}'.format(exce), file=sys.stderr)
                 continue
                 
-            # different processing steps
-            ms_data = to_microsecond(raw_data)
-            hist_data = to_ms_bins(ms_data, round_ms_digits=round_ms_digits)
-            box_data = to_expanded(ms_data)
-            normalized_data = normalize(hist_data)
-            accumulated_data = accumulate(normalized_data)
-            hdr_data = to_hdr(accumulated_data)
-            
-            
+            if aggregate:
+                aggregated += 1
+                if merged is None:
+                    merged = log_data
+                    first_exp = exp
+                else:
+                    merged = merged.merge(log_data)
+                continue
+                
             # store data
-            data[name] = {}
-            data[name]['hist'] = hist_data
-            data[name]['hist_norm'] = normalized_data
-            data[name]['cdf'] = accumulated_data
-            data[name]['hdr'] = hdr_data
-            data[name]['box'] = box_data
+            data[name] = process_hist_data(raw_data, round_ms_digits=round_ms_digits,
+                                           significant_digits=significant_digits)
             if progression_mapping_function:
                 data[name]['x_value'] = progression_mapping_function(exp)
+                
+        if merged is not None:
+            rprint('Aggregated {} histograms'.format(aggregated))
+            data[base_name] = process_hist_data(BinPyramid.from_histogram(merged.to_histogram()), merged,
+                                                round_ms_digits, significant_digits)
+            if progression_mapping_function:
+                data[base_name]['x_value'] = progression_mapping_function(first_exp)
 
     return data
 
-def extract_sequence_data(paths, basepath='/', sequence_file='sequence.csv'):
+def extract_sequence_data(paths, basepath='/', sequence_file='sequence.csv', sequence_buckets=SEQUENCE_BUCKETS,
+                          pcap_field=PCAP_FIELD):
     data = {}
     if not isinstance(paths, list):
         paths = [paths]
@@ -258,7 +335,7 @@ def extract_sequence_data(paths, basepath='/', sequence_file='sequence.csv'):
         experiment = os.path.join(extended_path, sequence_file)
         rprint('Processing ' + extended_path)
         
-        subexperiments = glob(experiment)
+        subexperiments = filter_captures(glob(experiment), pcap_field)
         update_name = False
         base_name = name
         if len(subexperiments) > 1:
@@ -273,15 +350,23 @@ def extract_sequence_data(paths, basepath='/', sequence_file='sequence.csv'):
             if update_name:
                 name = base_name + histo
         
-            # load data
+            # load data, streamed in blocks and reduced to the minimum and maximum of every bucket
+            files, kind, read = exp, '', lambda: read_sequence(exp, buckets=sequence_buckets)
+            if is_capture(exp):
+                files, kind = capture_files(exp, pcap_field), '-' + capture_kind(pcap_field)
+                read = lambda: read_capture_sequence(exp, pcap_field, buckets=sequence_buckets)
             try:
-                raw_data = read_2c_csv(exp)
+                raw_data = cached(files, 'seq{}{}'.format(sequence_buckets, kind), read,
+                                  encode_sequence, decode_sequence)
             except FileNotFoundError as exce:
                 rprint('Skipping - {}'.format(exce), file=sys.stderr)
                 continue
             
             # different processing steps
-            seq_data = to_microsecond(raw_data, keys=False, values=True)
+            seq_data = raw_data.to_unit(1000)
+            rprint('{} packets, {} plotted, min {:.3f} median {:.3f} max {:.3f} us'.format(
+                seq_data.count, len(seq_data), seq_data.minimum / 1000, seq_data.percentile(50),
+                seq_data.maximum / 1000))
             
             
             # store data
@@ -306,33 +391,55 @@ def get_sorted_values(xs, ys, sort_by='xs'):
     ys = [y for _,y in tup]
     return xs, ys
 
-def plot_sequence(data, name=''):
-    fig, ax = plt.subplots(figsize=(12,6))
-    ax.set_prop_cycle(tumcolor_cycler)
+def plot_sequence(data, name='', mode='points'):
+    if mode == 'density':
+        plot_sequence_density(data, name)
+        return
+    
+    figure = Figure(ylabel='Latency [$\mu$s]',
+                    xlabel='Number [-]',
+                    figsize=(12,6), legend=('upper left', (1, 1)))
     
     max_value = 0
     min_value = 1000000
     for exp, data in sorted(data.items()):
-        hist = data['seq']
-        xs = list(hist.keys())
-        ys = list(hist.values())
-        xs, ys = get_sorted_values(xs, ys)
-        max_value=max(max_value, max(xs))
-        min_value=min(min_value, min(xs))
-        ax.plot(xs, ys, marker='o', markersize=1, linestyle='', label=exp)
-
-    plt.ylim(bottom=0)
-                
-    ax.grid()
-    ax.set(ylabel='Latency [$\mu$s]',
-           xlabel='Number [-]')
-    ax.legend(loc='upper left', bbox_to_anchor=(1, 1))
-    
-    plt.xlim(left=min_value)
-    plt.xlim(right=max_value)
-    
-    save_plt('sequence', name=name)
-    plt.show()
+        seq = to_sequence(data['seq'])
+        if mode == 'envelope' and seq.density is not None:
+            # minimum, median and maximum per bucket, independent of the number of packets
+            xs, lows, medians, highs = seq.density.envelope()
+            style = figure.line(xs, medians, label=exp)
+            figure.band(xs, lows, highs, style)
+        else:
+            xs = seq.xs
+            ys = seq.ys
+            if not len(xs):
+                continue
+            figure.line(xs, ys, marker='o', markersize=1, linestyle='', label=exp)
+        max_value=max(max_value, xs[-1])
+        min_value=min(min_value, xs[0])
+
+    figure.set_ylim(bottom=0)
+    figure.set_xlim(left=min_value)
+    figure.set_xlim(right=max_value)
+    
+    figure.save('sequence' if mode == 'points' else 'sequence_' + mode, name=name)
+    
+def plot_sequence_density(data, name=''):
+    # one figure per experiment, packets binned by sequence number and latency and rendered as image
+    for i, (exp, data) in enumerate(sorted(data.items())):
+        seq = to_sequence(data['seq'])
+        if seq.density is None:
+            rprint('Skipping density of {} - no density data'.format(exp), file=sys.stderr)
+            continue
+        image, extent = seq.density.image()
+        
+        figure = Figure(title=exp,
+                        ylabel='Latency [$\mu$s]',
+                        xlabel='Number [-]',
+                        figsize=(12,6))
+        figure.image(image, extent, cmap=tumcolor_cmap)
+        
+        figure.save('sequence_density_{:03d}'.format(i), name=name)
 
 
 # In[ ]:
@@ -340,148 +447,126 @@ def plot_sequence(data, name=''):
 
 def plot_hist(data, name='', key='hist', ymax=None, ylabel='Occurence [-]',
               historgram_bar_width=0.005):
-    fig, ax = plt.subplots(figsize=(9,6))
-    ax.set_prop_cycle(tumcolor_cycler)
+    figure = Figure(ylabel=ylabel,
+                    xlabel='Latency [$\mu$s]',
+                    legend=('upper left', (1, 1)))
     
     max_value = 0
     data_points = 0
     for exp, data in sorted(data.items()):
-        hist = data[key]
-        xs = list(hist.keys())
+        hist = to_histogram(data[key])
         if key == 'hist':
             factor = 1
         else:
             # assume normalized
             factor = 100
-        ys = [factor * val for val in hist.values()]
-        if not ys:
+        ys = factor * hist.counts
+        if not len(ys):
             continue
-        tup = zip(xs, ys)
-        tup = sorted(tup, key=lambda x: x[0])
-        xs, ys = get_sorted_values(xs, ys)
         data_points += len(ys)
         max_value=max(max_value, max(ys))
-        ax.bar(xs, ys, width=historgram_bar_width, label=exp)
+        # one step line per experiment instead of one bar per bin, exported as pgfplots const plot
+        steps_xs, steps_ys = hist.steps(historgram_bar_width)
+        figure.line(steps_xs, factor * steps_ys, steps=True, label=exp)
 
     print('Total amount of data points: {}'.format(data_points))
     
     if not ymax:
         ymax = max_value
-    plt.ylim(bottom=0)
-    plt.ylim(top=ymax)
-                
-    ax.grid()
-    ax.set(ylabel=ylabel,
-           xlabel='Latency [$\mu$s]')
-    ax.legend(loc='upper left', bbox_to_anchor=(1, 1))
-    
-    plt.xlim(left=0)
+    figure.set_ylim(bottom=0)
+    figure.set_ylim(top=ymax)
+    figure.set_xlim(left=0)
     
-    save_plt(key, name=name)
-    plt.show()
+    figure.save(key, name=name)
 
 
 # In[ ]:
 
 
 def plot_cdf(data, name=''):
-    fig, ax = plt.subplots(figsize=(9,6))
-    ax.set_prop_cycle(tumcolor_cycler)
+    figure = Figure(ylabel='CDF [\%]',
+                    xlabel='Latency [$\mu$s]',
+                    legend=('upper left', (1, 1)))
     
     for exp, data in sorted(data.items()):
-        cdf = data['cdf']
-        xs = list(cdf.keys())
-        ys = [100 * val for val in cdf.values()]
-        xs, ys = get_sorted_values(xs, ys)
-        ax.plot(xs, ys, label=exp)
+        cdf = to_histogram(data['cdf'])
+        xs = cdf.xs
+        ys = 100 * cdf.counts
+        figure.line(xs, ys, label=exp)
 
 
-    plt.ylim(bottom=0)
-    plt.ylim(top=100)
-                
-    ax.grid()
-    ax.set(ylabel='CDF [\%]',
-           xlabel='Latency [$\mu$s]')
-    ax.legend(loc='upper left', bbox_to_anchor=(1, 1))
-    
-    plt.xlim(left=0)
+    figure.set_ylim(bottom=0)
+    figure.set_ylim(top=100)
+    figure.set_xlim(left=0)
     
-    save_plt('cdf', name=name)
-    plt.show()
+    figure.save('cdf', name=name)
 
 
 # In[ ]:
 
 
 def plot_hdr(data, name=''):
-    fig, ax = plt.subplots(figsize=(9,6))
-    ax.set_prop_cycle(tumcolor_cycler)
+    figure = Figure(xlabel='Percentile [\%] (log)',
+                    ylabel='Latency [$\mu$s] (log)',
+                    legend=('upper left', (1, 1)))
     
     max_value = 0
     min_value = 10000000000
+    max_percentile = 0
     for exp, data in sorted(data.items()):
-        hdr = data['hdr']
-        xs = list(hdr.values())
-        ys = list(hdr.keys())
-        if not ys:
+        # sorted by latency, 1/(1-p) grows with the latency
+        hdr = to_histogram(data['hdr'])
+        xs = hdr.counts
+        ys = hdr.xs
+        if not len(ys):
             continue
-        xs, ys = get_sorted_values(xs, ys)
-        max_value=max(max_value, max(ys))
-        min_value=min(min_value, min(ys))
-        ax.plot(xs, ys, label=exp)
+        max_value=max(max_value, ys[-1])
+        min_value=min(min_value, ys[0])
+        max_percentile=max(max_percentile, xs[-1])
+        figure.line(xs, ys, label=exp)
               
             
     # automatically determine min/max based on min/max values log10
     log_max = pow(10, math.ceil(math.log10(max_value)))
     log_min = pow(10, math.floor(math.log10(min_value)))
-    plt.ylim(bottom=log_min)
-    plt.ylim(top=log_max)
+    figure.set_ylim(bottom=log_min)
+    figure.set_ylim(top=log_max)
                 
-    ax.grid()
-    ax.set(xlabel='Percentile [\%] (log)',
-           ylabel='Latency [$\mu$s] (log)')
-    ax.set_xscale('log', subsx=[])
-    ax.set_yscale('log')
+    figure.set_xscale('log')
+    figure.set_yscale('log')
     ticks = [1, 2, 10, 100, 1000, 10000, 100000, 1000000]
     labels = ["0", "50", "90", "99", "99.9", "99.99", "99.999", "99.9999"]
-    plt.xticks(ticks, labels)
-    ax.legend(loc='upper left', bbox_to_anchor=(1, 1))
-    plt.xlim(left=1)
+    # the tail is only limited by the number of packets
+    while ticks[-1] < max_percentile:
+        ticks.append(ticks[-1] * 10)
+        labels.append(labels[-1] + '9')
+    figure.set_xticks(ticks, labels)
+    figure.set_xlim(left=1)
     # TODO determine xlim right
 
-    save_plt('hdr', name=name)
-    plt.show()
+    figure.save('hdr', name=name)
 
 
 # In[ ]:
 
 
 def plot_box(data, name=''):
-    fig, ax = plt.subplots(figsize=(9,6))
-    ax.set_prop_cycle(tumcolor_cycler)
+    figure = Figure(xlabel='',
+                    ylabel='Latency [$\mu$s]')
     
+    # box statistics straight from the histogram, the packets are never expanded
     boxes = []
     labels = []
     for exp, data in sorted(data.items()):
-        values = data['box']
-        boxes.append(values)
+        boxes.append(to_histogram(data['box']).box_stats(whis=1.5, label=exp))
         labels.append(exp)
-    ax.boxplot(boxes, showfliers=True, whis=1.5, labels=labels, patch_artist=True,
-               medianprops=dict(color='TUMOrange'),
-               boxprops=dict(facecolor='TUMWhite', color='TUMBlack'),
-               
-            )
+    figure.boxplot(boxes)
             
-    plt.ylim(bottom=0)
-    plt.xticks(ticks=range(1, len(labels) + 1), labels=labels)
-    plt.xlim(left=0.5, right=len(labels) + 0.5)
-                
-    ax.grid()
-    ax.set(xlabel='',
-           ylabel='Latency [$\mu$s]')
+    figure.set_ylim(bottom=0)
+    figure.set_xticks(range(1, len(labels) + 1), labels)
+    figure.set_xlim(left=0.5, right=len(labels) + 0.5)
 
-    save_plt('box', name=name)
-    plt.show()
+    figure.save('box', name=name)
 
 
 # In[ ]:
@@ -491,8 +576,9 @@ def plot_progression(data, name='', percentiles=None, xlabel='Unknown [-]'):
     if not percentiles:
         percentiles = [50]
     
-    fig, ax = plt.subplots(figsize=(9,6))
-    ax.set_prop_cycle(tumcolor_cycler)
+    figure = Figure(ylabel='Latency [$\mu$s]',
+                    xlabel=xlabel,
+                    legend=('center left', (1, 1)))
     
     values = dict()
     max_x_value = 0
@@ -508,7 +594,7 @@ def plot_progression(data, name='', percentiles=None, xlabel='Unknown [-]'):
         for percentile in percentiles:
             perc = -1
             try:
-                perc = np.percentile(data['box'], percentile)
+                perc = to_histogram(data['box']).percentile(percentile)
             except IndexError:
                 pass
             if not percentile in values[test]:
@@ -523,92 +609,61 @@ def plot_progression(data, name='', percentiles=None, xlabel='Unknown [-]'):
             ys = [y for _, y in data]
             max_x_value = max(max_x_value, max(xs))
             min_x_value = min(max_x_value, min(xs))
-            ax.plot(xs, ys, label='{} ({}th percentile)'.format(exp, percentile), marker='x')
+            figure.line(xs, ys, label='{} ({}th percentile)'.format(exp, percentile), marker='x')
 
-    plt.ylim(bottom=0)
-    plt.xlim(left=min_x_value)
-    plt.xlim(right=max_x_value)
-                
-    ax.grid()
-    ax.set(ylabel='Latency [$\mu$s]',
-           xlabel=xlabel)
-    ax.legend(loc='center left', bbox_to_anchor=(1, 1))
+    figure.set_ylim(bottom=0)
+    figure.set_xlim(left=min_x_value)
+    figure.set_xlim(right=max_x_value)
     
-    save_plt('progression_{}'.format('_'.join([str(p) for p in percentiles])), name=name)
-    plt.show()
+    figure.save('progression_{}'.format('_'.join([str(p) for p in percentiles])), name=name)
 
 
 # In[ ]:
 
 
-def plot_loop(name, content, mapping, hist_data, key=None):
+def loop_columns(data, metrics):
+    # all percentiles of one run for the loop table, at once from the histogram
+    percentiles = sorted({percentile for key in metrics for percentile in key})
+    try:
+        values = to_histogram(data['box']).percentile(percentiles)
+    except IndexError:
+        values = [-1] * len(percentiles)
+    return dict(zip(percentiles, values))
+
+def plot_loop(name, content, x, key=None, additional_plot_exports=None, confidence=DEFAULT_CONFIDENCE):
     if not key:
         key = [50]
+    # a list of (title, table) is drawn as one faceted figure
+    groups = content if isinstance(content, list) else [(None, content)]
     
-    fig, ax = plt.subplots(figsize=(9,6))
-    ax.set_prop_cycle(tumcolor_cycler)
-    
-    axis_label = None
-    xss = {}
-    yss = {}
-    mapped = {}
+    figures = [Figure() for _ in groups]
     
-    # gather data based on mapping
-    for exp, run, type in content:
-        axis_label = list(type.keys())[0]
-        if exp not in xss:
-            xss[exp] = []
-            yss[exp] = {}
-        xss[exp].append(list(type.values())[0])
-        try:
-            mapped[exp] = hist_data[mapping[exp][run]]
-        except KeyError as exce:
-            continue
-        else:
-            data = mapped[exp]
-            for percentile in key:
-                perc = -1
-                try:
-                    perc = np.percentile(data['box'], percentile)
-                except IndexError:
-                    pass
-                if not percentile in yss[exp]:
-                    yss[exp][percentile] = []
-                yss[exp][percentile].append(perc)
-        
-    for exp, data in sorted(mapped.items()):
-        for percentile in sorted(key):
-            ys = yss[exp][percentile]
-            xs = xss[exp]
-            zipped = list(zip(xs, ys))
-            zipped.sort(key=lambda tup: tup[0])
-            xs, ys = zip(*zipped)
-            
-            ax.plot(xs, ys, marker='x', label = exp)
+    # one series per experiment and percentile, all from the loop table
+    exps = sorted({exp for _, table in groups for exp in table.exps[table.found]})
+    series = [(exp, exp, percentile) for exp in exps for percentile in sorted(key)]
+    facets = []
+    for figure, (title, table) in zip(figures, groups):
+        facets.append((title, plot_loop_series(figure, table, x, series, confidence=confidence)))
     
-    plt.ylim(bottom=0)
     #plt.xlim(left=min_x_value)
     #plt.xlim(right=max_x_value)
-                
-    ax.grid()
-    ax.set(ylabel='Latency [$\mu$s]',
-           xlabel=axis_label)
-    ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
     
-    save_plt('loop_{}'.format('_'.join([str(p) for p in key])), name=name)
-    plt.show()
+    save_loop_plot('loop_{}'.format('_'.join([str(p) for p in key])), figures, facets, x, 'Latency [$\mu$s]',
+                   name=name, exports=additional_plot_exports)
 
 
 # In[ ]:
 
 
-def _plot_sequence(paths, name, sequence_file, **kwargs):
+def _plot_sequence(paths, name, sequence_file, sequence_buckets=SEQUENCE_BUCKETS, sequence_mode='points',
+                   pcap_field=PCAP_FIELD, **kwargs):
     print('------------- plotting sequence data ------------')
-    seq_data = extract_sequence_data(paths, sequence_file=sequence_file, **kwargs)
+    seq_data = extract_sequence_data(paths, sequence_file=sequence_file, sequence_buckets=sequence_buckets,
+                                     pcap_field=pcap_field, **kwargs)
     if not seq_data:
         rprint('No sequence data found', file=sys.stderr)
     else:
-        plot_sequence(seq_data, name)
+        plot_sequence(seq_data, name, mode=sequence_mode)
         
 def _plot_default_histogram(name, hist_data, historgram_bar_width):
     print('------------ plotting default histogram data ----------')
@@ -633,17 +688,20 @@ def plot(paths, name=None, default_plots=True, percentiles=None,
          histogram_file=None, round_ms_digits=3, historgram_bar_width=0.005,
          sequence_file=None,
          progression_mapping_function=None, progression_x_label=None,
-         loop_file=None, loop_order=None,
+         loop_file=None, loop_order=None, confidence=DEFAULT_CONFIDENCE, loop_facets=False,
+         aggregate=False, significant_digits=HDR_SIGNIFICANT_DIGITS, sequence_buckets=SEQUENCE_BUCKETS,
+         sequence_mode='points', pcap_field=PCAP_FIELD,
          **kwargs):
     
     if sequence_file:
-        _plot_sequence(paths, name, sequence_file, **kwargs)
+        _plot_sequence(paths, name, sequence_file, sequence_buckets, sequence_mode, pcap_field, **kwargs)
     
     if histogram_file:
         # histogram data
         hist_data = extract_hist_data(paths, histogram_file=histogram_file, round_ms_digits=round_ms_digits,
                                       progression_mapping_function=progression_mapping_function,
-                                      **kwargs)
+                                      aggregate=aggregate, significant_digits=significant_digits,
+                                      pcap_field=pcap_field, **kwargs)
         if not hist_data:
             rprint('No histogram data found', file=sys.stderr)
             return
@@ -663,7 +721,8 @@ def plot(paths, name=None, default_plots=True, percentiles=None,
     if (loop_file and not loop_order) or (loop_order and not loop_file):
         raise RuntimeError('must define loop_file AND loop_order if using loop variables')
     if loop_file and loop_order:
-        _plot_loop(paths, name, hist_data, loop_file, loop_order, percentiles, plot_loop, **kwargs)
+        _plot_loop(paths, name, hist_data, loop_file, loop_order, percentiles, plot_loop, None, loop_columns,
+                   confidence=confidence, facets=loop_facets, **kwargs)
 
 
 # In[ ]:
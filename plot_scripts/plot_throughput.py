@@ -14,13 +14,32 @@
 # [Device: id=0] TX: 0.10 Mpps, 51 Mbit/s (67 Mbit/s with framing)
 # ...
 # ```
+# * csv files (--throughput-format csv) of the same run are merged if they only differ in rx/tx
+#   * e.g. throughput_run000-rx.csv and throughput_run000-tx.csv
+# ```
+# Time,Direction,Id,PacketRate,Mbit,MbitWithFraming,TotalPackets,TotalBytes
+# 1602105032.58,TX,Device: id=0,0.098200,53.43,69.14,98200,6677600
+# ```
 # 
 # ### Features
 # * througput (with and without framing), packet rate
-# * min, max, avg of the above
+# * min, max, avg, standard deviation and percentiles of the above
+# * packet loss based on the total packets sent and received
+# * follow mode (--follow) printing rolling statistics of growing stdout files, e.g. of running experiments
+# * optional steady state detection instead of a fixed strip (--throughput-steady-state)
+#   * warm-up, end of the steady state and the time until the mean converged are available as metrics
 # * plots loop experiment
 #   * define the order of loop variables
+#   * repeated runs of the same loop point are averaged, with bootstrap confidence intervals as error bands
+#   * --loop-facets for one faceted figure (pgfplots groupplot) of all groups instead of one figure per group
+#   * loop files are read concurrently (orjson if installed) and cached as one table per folder
+# * parsed files are cached in .plot-cache next to the data, --no-cache to parse them again
 # * figures created in figures/*.tex
+#  * written as pgfplots straight from the data, --tex-backend tikzplotlib to convert matplotlib figures instead
+#  * matplotlib only draws the figure for additional exports (e.g. svg) and previews in notebooks
+#  * figures whose data did not change are not written again (figures/.manifest.json), --no-figure-cache to force
+#  * --list-stale and --prune-stale for files written for figures that no figure writes anymore, e.g. of another backend
+#  * independent figures are written in parallel by --render-processes forked processes, each file is written atomically
 # * externalized data into data/*.tsv
 # * makefile to generate pdfs
 # 
@@ -29,15 +48,15 @@
 # 
 # ## errors
 # * if you get tex capacity exceeded when trying to compile the figures you have too many data points
+#  * lines are decimated to at most --max-points per figure, keeping the minimum and maximum of each bucket
 
 # In[ ]:
 
 
 import os
 import sys
-import matplotlib.pyplot as plt
+import time
 import matplotlib.ticker as ticker
-from matplotlib.pyplot import savefig
 from glob import glob
 rprint=print
 from pprint import pprint as print
@@ -49,10 +68,16 @@ import numpy as np
 
 # import other utility notebooks
 import import_ipynb
-# NOTE: tumcolors only work with python 3.6 and newer
-from util.tumcolor import tumcolor_cycler
-from util.i8_tikzplotlib import save_plt
-from util.loop_plot import _plot_loop
+from util.i8_tikzplotlib import configure_tikz
+from util.loop_plot import _plot_loop, plot_loop_series, save_loop_plot
+from util.figure import (Figure, FIGURE_BACKENDS, configure_figures, print_figure_stats, stale_artifacts,
+                         prune_artifacts, figure_pool)
+from util.bootstrap import DEFAULT_CONFIDENCE
+from util.cache import configure_cache, print_cache_stats, cached, encode_run, decode_run
+from util.moongen import (MOONGEN_DATA_OUTPUT, DEFAULT_PERCENTILES, ParsingError, get_devices, read_moongen_stdout,
+                          read_moongen_summary, is_summary_only, read_moongen_csv, group_csv_files,
+                          add_statistics, to_percentile_name, add_steady_state, STEADY_STATE,
+                          new_follow_state, follow_moongen_stdout, is_finished)
 
 
 # In[ ]:
@@ -79,36 +104,113 @@ def run_from_cli():
     
     parser.add_argument('--throughput-filename', metavar='TP_FILENAME', type=str, default='throughput.csv',
                         help='name of the throughput data file, wildcard possible')
+    parser.add_argument('--throughput-format', metavar='TP_FORMAT', type=str, default='stdout',
+                        choices=['stdout', 'csv'], help='format of the throughput data files (stdout or csv)')
     parser.add_argument('--throughput-strip', metavar='TP_STRIP', type=int, default=0,
                         help='the amount of lines from moongen stdout that should be skipped (tail AND head)')
+    parser.add_argument('--throughput-steady-state', action='store_true',
+                        help='detect the steady state of every run and use it instead of TP_STRIP')
+    parser.add_argument('--steady-state-window', metavar='WINDOW', type=int, default=STEADY_STATE['window'],
+                        help='seconds that must be within the tolerance to count as steady state')
+    parser.add_argument('--steady-state-tolerance', metavar='TOLERANCE', type=float, default=STEADY_STATE['tolerance'],
+                        help='relative spread allowed within the steady state window')
+    parser.add_argument('--steady-state-confidence', metavar='CONFIDENCE', type=float,
+                        default=STEADY_STATE['confidence'], help='confidence level for the convergence of the mean')
+    parser.add_argument('--steady-state-precision', metavar='PRECISION', type=float,
+                        default=STEADY_STATE['precision'], help='relative half width of the confidence interval')
+    parser.add_argument('--throughput-percentile', metavar='TP_PERCENTILE', type=float, action='append',
+                        help='Percentile(s) calculated per run, available as pPERCENTILE_* metrics')
+
+    parser.add_argument('--confidence', metavar='CONFIDENCE', type=float, default=DEFAULT_CONFIDENCE,
+                        help='confidence level of the bands drawn for repeated runs of the same loop point')
+    parser.add_argument('--follow', action='store_true',
+                        help='print rolling statistics of growing stdout files instead of plotting, stop with ctrl-c')
+    parser.add_argument('--follow-interval', metavar='SECONDS', type=float, default=1,
+                        help='seconds between checking for new data in follow mode')
+    parser.add_argument('--follow-window', metavar='SECONDS', type=int, default=10,
+                        help='number of seconds the rolling statistics are calculated for')
 
     parser.add_argument('--loop-filename', metavar='LOOP_FILENAME', type=str,
                         help='name of the throughput data file, wildcard possible')
     parser.add_argument('--loop-order', metavar='LOOP_ORDER', type=str, action='append',
                         help='Order of the loop variables')
+    parser.add_argument('--loop-facets', action='store_true',
+                        help='all groups of a loop plot in one faceted figure (groupplot) instead of one figure each')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='parse all files again instead of using the cache next to them')
+    parser.add_argument('--cache-size', metavar='CACHE_SIZE', type=int, default=256,
+                        help='maximum size of the cache per directory in MiB, least recently used entries are evicted')
+    parser.add_argument('--max-points', metavar='MAX_POINTS', type=int, default=20000,
+                        help='maximum number of points of all lines of a figure, lines are decimated to their minima and maxima')
+    parser.add_argument('--tex-backend', choices=FIGURE_BACKENDS, default='pgfplots',
+                        help='write figures as pgfplots straight from the data or convert matplotlib figures with tikzplotlib')
+    parser.add_argument('--no-figure-cache', action='store_true',
+                        help='write all figures again, even if their data did not change since the last run')
+    parser.add_argument('--render-processes', metavar='RENDER_PROCESSES', type=int, default=None,
+                        help='processes writing the figures in parallel, at most one per figure, default is one per cpu')
+    parser.add_argument('--list-stale', action='store_true',
+                        help='list files once written for a figure in figures/ and data/ that no figure writes anymore')
+    parser.add_argument('--prune-stale', action='store_true',
+                        help='remove these files after plotting')
 
     args = parser.parse_args()
     if args.label and not len(args.label) == len(args.path):
         raise argparse.ArgumentTypeError('Must provide a label for either no or all paths')
+    if args.follow and not args.throughput_format == 'stdout':
+        raise argparse.ArgumentTypeError('Follow mode only supports MoonGen stdout')
         
     experiments = []
     if args.label:
         experiments = list(zip(args.path, args.label))
     else:
         experiments = args.path
+
+    steady_state = None
+    if args.throughput_steady_state:
+        steady_state = {
+            'window'    : args.steady_state_window,
+            'tolerance' : args.steady_state_tolerance,
+            'confidence': args.steady_state_confidence,
+            'precision' : args.steady_state_precision,
+        }
         
-    plot(experiments,
-         basepath=args.basepath,
-         name=args.name,
-         additional_plot_exports=args.additional_export,
-         throughput_file=args.throughput_filename,
-         throughput_strip=args.throughput_strip,
+    if args.follow:
+        follow(experiments,
+               basepath=args.basepath,
+               throughput_file=args.throughput_filename,
+               interval=args.follow_interval,
+               window=args.follow_window,
+        )
+        sys.exit()
+
+    configure_cache(enabled=not args.no_cache, max_size=args.cache_size * 1024 * 1024)
+    configure_tikz(max_points=args.max_points)
+    configure_figures(backend=args.tex_backend, cache=not args.no_figure_cache)
+    with figure_pool(args.render_processes):
+        plot(experiments,
+             basepath=args.basepath,
+             name=args.name,
+             additional_plot_exports=args.additional_export,
+             throughput_file=args.throughput_filename,
+             throughput_format=args.throughput_format,
+             throughput_strip=args.throughput_strip,
+             throughput_percentiles=args.throughput_percentile,
+             throughput_steady_state=steady_state,
          
-         metrics=args.metric,
+             metrics=args.metric,
          
-         loop_file=args.loop_filename,
-         loop_order=args.loop_order
-    )
+             loop_file=args.loop_filename,
+             loop_order=args.loop_order,
+             loop_facets=args.loop_facets,
+             confidence=args.confidence,
+        )
+    print_cache_stats()
+    print_figure_stats()
+    if args.list_stale:
+        for path in stale_artifacts():
+            rprint(path)
+    if args.prune_stale:
+        prune_artifacts()
         
     sys.exit()
 
@@ -116,105 +218,9 @@ def run_from_cli():
 # In[ ]:
 
 
-MOONGEN_DATA_OUTPUT = ['mpps', 'mbit', 'mbitcrc']
-
-class ParsingError(Exception):
-    pass
-
-def read_moongen_stdout(exp, strip):
-    data = dict()
-    valid_file = dict()
-    # id, direction, mpps, mbit, mbit with framing
-    with open(exp) as infile:
-        # [Packets counted] RX: 0.10 Mpps, 49 Mbit/s (65 Mbit/s with framing)
-        # [Device: id=0] TX: 0.10 Mpps, 51 Mbit/s (67 Mbit/s with framing)
-        for line in infile:
-            # filter unwanted lines
-            if not (('[Packets counted]' in line or '[Device: id=' in line) and ('RX' in line or 'TX' in line)):
-                continue
-                
-            # check if we reached the last lines containing the summary
-            summary = False
-            if 'StdDev' in line and 'total' in line:
-                summary = True
-                
-            cid = 0
-            direction = 'rx'
-            mpps = 0 
-            mbit = 0
-            mbitcrc = 0
-            
-            parts = line.split('] ')            
-            # get ID
-            if parts[0].endswith('Packets counted'):
-                #TODO does this make sense?
-                cid = 0
-            else:
-                cid = int(parts[0].split('=')[-1])
-                
-            # get direction
-            parts = parts[1].split(' ')
-            if parts[0].startswith('RX'):
-                direction = 'rx'
-            elif parts[0].startswith('TX'):
-                direction = 'tx'
-            else:
-                raise ValueError('Unable to parse direction: {}'.format(line))
-            
-            # prepare structure
-            if not cid in data:
-                data[cid] = dict()
-            if not direction in data[cid]:
-                data[cid][direction] = dict()
-            for item in MOONGEN_DATA_OUTPUT:
-                if not item in data[cid][direction]:
-                    data[cid][direction][item] = list()
-                
-            # get other data
-            if not summary:
-                mpps = float(parts[1])
-                mbit = float(parts[3])
-                mbitcrc = float(parts[5][1:])
-                
-                data[cid][direction]['mpps'].append(mpps)
-                data[cid][direction]['mbit'].append(mbit)
-                data[cid][direction]['mbitcrc'].append(mbitcrc)
-                valid_file[direction] = True
-            else:
-                mpps = float(parts[1])
-                mbit = float(parts[5])
-                mbitcrc = float(parts[9][1:])
-                
-                data[cid][direction]['avg_mg_mpps'] = mpps
-                data[cid][direction]['avg_mg_mbit'] = mbit
-                data[cid][direction]['avg_mg_mbitcrc'] = mbitcrc
-                
-                # add self calculated averages with skips as default
-                data[cid][direction]['avg_mpps'] = np.mean(data[cid][direction]['mpps'][strip:-(strip+1)])
-                data[cid][direction]['avg_mbit'] = np.mean(data[cid][direction]['mbit'][strip:-(strip+1)])
-                data[cid][direction]['avg_mbitcrc'] = np.mean(data[cid][direction]['mbitcrc'][strip:-(strip+1)])
-                
-                valid_file[direction + '_summary'] = True
-        if not len(valid_file.keys()) == 4:
-            raise ParsingError('Invalid file: {}'.format(valid_file))
-                
-    return data
-
-
-# In[ ]:
-
-
-def add_values(data, prefix, func, strip):
-    for cid, data2 in data.items():
-        for direction, data3 in data2.items():
-            for item in MOONGEN_DATA_OUTPUT:
-                data[cid][direction][prefix + '_' + item] = func(data3[item][strip:-(strip+1)])
-
-
-# In[ ]:
-
-
-def extract_tp_data(paths, basepath='/', throughput_file='histogram.csv', throughput_strip=0):
+def extract_tp_data(paths, basepath='/', throughput_file='histogram.csv', throughput_format='stdout',
+                    throughput_strip=0, throughput_percentiles=None, throughput_steady_state=None,
+                    summary_only=False):
     data = {}
     if not isinstance(paths, list):
         paths = [paths]
@@ -232,6 +238,8 @@ def extract_tp_data(paths, basepath='/', throughput_file='histogram.csv', throug
         rprint('Processing ' + extended_path)
         
         subexperiments = glob(experiment)
+        if throughput_format == 'csv':
+            subexperiments = group_csv_files(subexperiments)
         update_name = False
         base_name = name
         if len(subexperiments) > 1:
@@ -252,14 +260,22 @@ def extract_tp_data(paths, basepath='/', throughput_file='histogram.csv', throug
                 
             # load data
             try:
-                raw_data = read_moongen_stdout(exp, throughput_strip)
+                if throughput_format == 'csv':
+                    raw_data = cached(subexperiments[exp], 'csv', lambda: read_moongen_csv(subexperiments[exp]),
+                                      encode_run, decode_run)
+                elif summary_only:
+                    raw_data = cached(exp, 'summary', lambda: read_moongen_summary(exp), encode_run, decode_run)
+                else:
+                    raw_data = cached(exp, 'stdout', lambda: read_moongen_stdout(exp), encode_run, decode_run)
             except (FileNotFoundError, ParsingError) as exce:
                 rprint('Skipping {} - {}'.format(histo, exce), file=sys.stderr)
                 continue
                 
             # different processing steps
-            add_values(raw_data, 'max', max, throughput_strip)
-            add_values(raw_data, 'min', min, throughput_strip)
+            # throughput_steady_state is a dict of parameters for add_steady_state, {} for the defaults
+            if throughput_steady_state is not None:
+                add_steady_state(raw_data, **throughput_steady_state)
+            add_statistics(raw_data, throughput_strip, percentiles=throughput_percentiles)
             
             # store data
             data[name] = {}
@@ -271,78 +287,101 @@ def extract_tp_data(paths, basepath='/', throughput_file='histogram.csv', throug
 # In[ ]:
 
 
-def plot_loop(name, content, mapping, tp_data, key='max_mbit', additional_plot_exports=None):
-    if not additional_plot_exports:
-        additional_plot_exports = []
-        
-    fig, ax = plt.subplots(figsize=(9,6))
-    ax.set_prop_cycle(tumcolor_cycler)
-    
-    axis_label = None
-    xss = {}
-    yss = {}
-    mapped = {}
-    
-    # gather data based on mapping
-    for exp, run, type in content:
-        axis_label = list(type.keys())[0]
-        if exp not in xss:
-            xss[exp] = []
-            yss[exp] = {}
-        xss[exp].append(list(type.values())[0])
-        try:
-            mapped[exp] = tp_data[mapping[exp][run]]
-        except KeyError as exce:
+def print_rolling_stats(name, run, window=10):
+    for cid, direction in get_devices(run):
+        if not (cid, direction, MOONGEN_DATA_OUTPUT[0]) in run:
             continue
-        else:
-            mapped[exp] = mapped[exp]['tp']
-            for cid, data in mapped[exp].items():
-                for direction, data in data.items():
-                    y = data[key]
-                    full = '{}-{}-{}'.format(exp, cid, direction)
+        mpps, mbit, _ = [run[(cid, direction, item)] for item in MOONGEN_DATA_OUTPUT]
+        if not len(mpps):
+            continue
+        rprint('{} [{}] {} {:4d}s: {:8.3f} Mpps {:10.1f} Mbit/s, last {}s: {:8.3f} Mpps {:10.1f} Mbit/s'.format(
+            name, cid, direction.upper(), len(mpps), mpps.mean(), mbit.mean(),
+            window, mpps[-window:].mean(), mbit[-window:].mean()), flush=True)
+
+def follow(paths, basepath='/', throughput_file='throughput.log', interval=1, window=10):
+    # tail growing MoonGen stdout files, e.g. of a running pos experiment
+    # new files matching the wildcard are picked up, finished files are not read again
+    if not isinstance(paths, list):
+        paths = [paths]
+    states = {}
+    try:
+        while True:
+            for path in paths:
+                name = path
+                if isinstance(path, tuple):
+                    name = path[1]
+                    path = path[0]
+                experiment = os.path.join(basepath, path, throughput_file)
+                for exp in sorted(glob(experiment)):
+                    if exp not in states:
+                        states[exp] = new_follow_state()
+                    state = states[exp]
+                    if is_finished(state):
+                        continue
                     try:
-                        yss[exp][full].append(y)
-                    except KeyError:
-                        yss[exp][full] = [y]
+                        count = follow_moongen_stdout(exp, state)
+                    except FileNotFoundError:
+                        continue
+                    label = '{} {}'.format(name, os.path.basename(exp))
+                    if count:
+                        print_rolling_stats(label, state['run'], window)
+                    if is_finished(state):
+                        rprint('{} finished'.format(label), flush=True)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+
+# In[ ]:
+
+
+def loop_columns(data, metrics):
+    # the metrics of every device of one run for the loop table
+    return {(cid, direction, metric): value for (cid, direction, metric), value in data['tp'].items()
+            if metric in metrics}
+
+def plot_loop(name, content, x, key='max_mbit', additional_plot_exports=None, confidence=DEFAULT_CONFIDENCE):
+    # a list of (title, table) is drawn as one faceted figure
+    groups = content if isinstance(content, list) else [(None, content)]
         
-    for exp, data in sorted(mapped.items()):
-        for cid, data in sorted(data.items()):
-            for direction, data in sorted(data.items()):
-                full = '{}-{}-{}'.format(exp, cid, direction)
-                ys = yss[exp][full]
-                xs = xss[exp]
-                zipped = list(zip(xs, ys))
-                zipped.sort(key=lambda tup: tup[0])
-                xs, ys = zip(*zipped)
-                
-                ax.plot(xs, ys, marker='x', label = full)
+    figures = [Figure() for _ in groups]
+    
+    # one series per experiment and device with the metric, all from the loop table
+    series = []
+    for exp in sorted({exp for _, table in groups for exp in table.exps[table.found]}):
+        columns = [column for _, table in groups for column in table.columns
+                   if isinstance(column, tuple) and column[2] == key
+                   and not np.isnan(table[column][table.found & (table.exps == exp)]).all()]
+        for cid, direction in get_devices(columns):
+            series.append(('{}-{}-{}'.format(exp, cid, direction), exp, (cid, direction, key)))
+    facets = []
+    for figure, (title, table) in zip(figures, groups):
+        facets.append((title, plot_loop_series(figure, table, x, series, confidence=confidence)))
     
-    plt.ylim(bottom=0)
     #plt.xlim(left=min_x_value)
     #plt.xlim(right=max_x_value)
-                
-    ax.grid()
-    ax.set(ylabel=METRIC_TO_LABEL[key],
-           xlabel=axis_label)
-    ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
     
-    save_plt('loop_{}'.format(key), name=name)
-    for ape in additional_plot_exports:
-        rprint('Additional export as {}'.format(ape))
-        savefig('figures/{}_loop_{}.{}'.format(name, key, ape), format=ape)
-    plt.show()
+    save_loop_plot('loop_{}'.format(key), figures, facets, x, METRIC_TO_LABEL[key], name=name,
+                   exports=additional_plot_exports)
 
 
 # In[ ]:
 
 
-def plot(paths, name=None, throughput_file=None, throughput_strip=0,
+def plot(paths, name=None, throughput_file=None, throughput_format='stdout',
+         throughput_strip=0, throughput_percentiles=None, throughput_steady_state=None,
          additional_plot_exports=None, metrics=None,
-         loop_file=None, loop_order=None,
+         loop_file=None, loop_order=None, confidence=DEFAULT_CONFIDENCE, loop_facets=False,
          **kwargs):
     
     # extract throughput data
-    tp_data = extract_tp_data(paths, throughput_file=throughput_file, throughput_strip=throughput_strip, **kwargs)
+    # only the summary at the end of each file is read if it contains all requested metrics
+    summary_only = throughput_format == 'stdout' and is_summary_only(metrics)
+    if summary_only:
+        rprint('Reading summaries only')
+    tp_data = extract_tp_data(paths, throughput_file=throughput_file, throughput_format=throughput_format,
+                              throughput_strip=throughput_strip, throughput_percentiles=throughput_percentiles,
+                              throughput_steady_state=throughput_steady_state, summary_only=summary_only, **kwargs)
     
     if not tp_data:
         rprint('No throughput data found', file=sys.stderr)
@@ -351,10 +390,13 @@ def plot(paths, name=None, throughput_file=None, throughput_strip=0,
     if not metrics:
         print('you need to define the metrics of interest (METRIC_TO_LABEL.keys())')
         return
+    if throughput_percentiles:
+        METRIC_TO_LABEL.update(get_percentile_labels(throughput_percentiles))
     if (loop_file and not loop_order) or (loop_order and not loop_file):
         raise RuntimeError('must define loop_file AND loop_order if using loop variables')
     if loop_file and loop_order:
-        _plot_loop(paths, name, tp_data, loop_file, loop_order, metrics, plot_loop, additional_plot_exports, **kwargs)
+        _plot_loop(paths, name, tp_data, loop_file, loop_order, metrics, plot_loop, additional_plot_exports,
+                   loop_columns, confidence=confidence, facets=loop_facets, **kwargs)
 
 
 # In[ ]:
@@ -373,8 +415,29 @@ METRIC_TO_LABEL = {
     'avg_mg_mbit'   : 'Average Throughput [Mbit/s]',
     'avg_mg_mbitcrc': 'Average Throughput (with Framing) [Mbit/s]',
     'avg_mg_mpps'   : 'Average Packet Rate [Mpps]',
+    'std_mbit'   : 'Standard Deviation of Throughput [Mbit/s]',
+    'std_mbitcrc': 'Standard Deviation of Throughput (with Framing) [Mbit/s]',
+    'std_mpps'   : 'Standard Deviation of Packet Rate [Mpps]',
+    'total_packets': 'Total Packets [-]',
+    'total_bytes'  : 'Total Bytes (with CRC) [B]',
+    'loss_packets' : 'Packet Loss [-]',
+    'loss_ratio'   : 'Packet Loss Ratio [-]',
+    'steady_start'    : 'Warm-up [s]',
+    'steady_end'      : 'End of Steady State [s]',
+    'steady_converged': 'Time until Convergence [s]',
 }
 
+def get_percentile_labels(percentiles):
+    labels = {
+        'mbit'   : 'Throughput [Mbit/s]',
+        'mbitcrc': 'Throughput (with Framing) [Mbit/s]',
+        'mpps'   : 'Packet Rate [Mpps]',
+    }
+    return {'{}_{}'.format(to_percentile_name(percentile), item): '{:g}th Percentile {}'.format(percentile, label)
+            for percentile in percentiles for item, label in labels.items()}
+
+METRIC_TO_LABEL.update(get_percentile_labels(DEFAULT_PERCENTILES))
+
 
 # In[ ]:
 
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+
+
+import numpy as np
+
+
+# In[ ]:
+
+
+DEFAULT_CONFIDENCE = 0.95
+BOOTSTRAP_RESAMPLES = 1000
+# fixed seed, the same runs always result in the same figures
+BOOTSTRAP_SEED = 0
+# upper bound for the number of resampled values held in memory at once
+BOOTSTRAP_CHUNK_SIZE = 10000000
+
+
+# In[ ]:
+
+
+def group_runs(keys, values):
+    # one row per group of identical keys, padded with nan, e.g. repeated runs of the same loop point
+    keys = np.asarray(keys)
+    values = np.asarray(values, dtype=np.float64)
+    unique, first, inverse, counts = np.unique(keys, axis=0, return_index=True, return_inverse=True,
+                                               return_counts=True)
+    inverse = inverse.reshape(-1)
+
+    # position of every value within its group
+    order = np.argsort(inverse, kind='stable')
+    position = np.arange(len(order)) - np.repeat(np.cumsum(counts) - counts, counts)
+    grouped = np.full((len(unique), counts.max(initial=0)), np.nan)
+    grouped[inverse[order], position] = values[order]
+    return first, grouped, counts
+
+def bootstrap_ci(grouped, counts, confidence=DEFAULT_CONFIDENCE, resamples=BOOTSTRAP_RESAMPLES, seed=BOOTSTRAP_SEED):
+    # percentile bootstrap of the mean, all groups are resampled at once
+    groups, size = grouped.shape
+    if grouped.size == 0:
+        return np.empty(groups), np.empty(groups)
+    rng = np.random.default_rng(seed)
+    # padding is never drawn, but masked to keep the shape of all groups equal
+    mask = np.arange(size) < counts[:, None, None]
+
+    means = []
+    chunk = max(1, BOOTSTRAP_CHUNK_SIZE // max(1, groups * size))
+    for done in range(0, resamples, chunk):
+        draws = (rng.random((groups, min(chunk, resamples - done), size)) * counts[:, None, None]).astype(np.intp)
+        samples = np.take_along_axis(grouped, draws.reshape(groups, -1), axis=1).reshape(draws.shape)
+        means.append(np.where(mask, samples, 0).sum(axis=-1) / counts[:, None])
+    means = np.concatenate(means, axis=1)
+
+    lower, upper = np.percentile(means, [50 * (1 - confidence), 50 * (1 + confidence)], axis=1)
+    return lower, upper
+
+def aggregate_runs(keys, values, confidence=DEFAULT_CONFIDENCE, resamples=BOOTSTRAP_RESAMPLES, seed=BOOTSTRAP_SEED):
+    # returns the index of the first run, mean, confidence interval and number of runs per group
+    first, grouped, counts = group_runs(keys, values)
+    mean = np.where(np.arange(grouped.shape[1]) < counts[:, None], grouped, 0).sum(axis=1) / counts
+    lower, upper = bootstrap_ci(grouped, counts, confidence, resamples, seed)
+    return first, mean, lower, upper, counts
+
+
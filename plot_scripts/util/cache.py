@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+
+
+import os
+import sys
+import json
+import time
+import hashlib
+import zipfile
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+rprint=print
+from pprint import pprint as print
+
+
+# In[ ]:
+
+
+# parsed files are cached in a sidecar directory next to the data, one npz file per parsed file
+# the cache key contains the path, size and mtime of all files, changed files are parsed again
+# bump the version whenever a parser returns something different
+CACHE_VERSION = 2
+CACHE_DIRNAME = '.plot-cache'
+CACHE_SETTINGS = {
+    'enabled' : True,
+    'max_size': 256 * 1024 * 1024, # per sidecar directory, in bytes
+    'threads' : 16, # concurrent file system calls, e.g. for many small files on NFS
+}
+CACHE_STATS = {
+    'hits'     : 0,
+    'misses'   : 0,
+    'writes'   : 0,
+    'evictions': 0,
+}
+# sidecar directory -> its entries {filename: [mtime, size]} and their total size
+# scanned on the first write of a process and kept up to date afterwards
+CACHE_DIRS = {}
+
+def configure_cache(enabled=True, max_size=None, threads=None):
+    CACHE_SETTINGS['enabled'] = enabled
+    if max_size is not None:
+        CACHE_SETTINGS['max_size'] = max_size
+    if threads is not None:
+        CACHE_SETTINGS['threads'] = threads
+
+def map_files(function, files):
+    # in a bounded thread pool, the calls mostly wait for the file system
+    if len(files) < 2 or CACHE_SETTINGS['threads'] < 2:
+        return [function(exp) for exp in files]
+    with ThreadPoolExecutor(max_workers=CACHE_SETTINGS['threads']) as pool:
+        return list(pool.map(function, files))
+
+def print_cache_stats():
+    if CACHE_SETTINGS['enabled']:
+        rprint('Cache: {hits} hits, {misses} misses, {writes} writes, {evictions} evictions'.format(**CACHE_STATS))
+
+
+# In[ ]:
+
+
+def get_cache_file(files, kind, folder=False):
+    key = [CACHE_VERSION, kind]
+    if folder:
+        # the names of the files and the mtime of their directories, which changes whenever a file is added,
+        # removed or renamed, one stat per directory instead of per file but files changed in place are missed
+        directories = sorted({os.path.dirname(os.path.abspath(exp)) for exp in files})
+        key.append(sorted(os.path.abspath(exp) for exp in files))
+        key += [(directory, os.stat(directory).st_mtime_ns) for directory in directories]
+    else:
+        for exp, stat in zip(files, map_files(os.stat, files)):
+            key.append((os.path.abspath(exp), stat.st_size, stat.st_mtime_ns))
+    digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()[:16]
+    path, filename = os.path.split(files[0])
+    return os.path.join(path, CACHE_DIRNAME, '{}.{}.{}.npz'.format(filename, kind, digest))
+
+def load_cache_file(cache_file):
+    with np.load(cache_file, allow_pickle=False) as columns:
+        data = {key: columns[key] for key in columns.files}
+    # mark as recently used for the eviction
+    os.utime(cache_file)
+    cache_dir, filename = os.path.split(cache_file)
+    if cache_dir in CACHE_DIRS and filename in CACHE_DIRS[cache_dir]['entries']:
+        CACHE_DIRS[cache_dir]['entries'][filename][0] = time.time()
+    return data
+
+def cache_dir_entries(cache_dir):
+    if cache_dir not in CACHE_DIRS:
+        entries = {}
+        for entry in os.scandir(cache_dir):
+            if entry.name.endswith('.npz'):
+                stat = entry.stat()
+                entries[entry.name] = [stat.st_mtime, stat.st_size]
+        CACHE_DIRS[cache_dir] = {'entries': entries, 'size': sum(size for _, size in entries.values())}
+    return CACHE_DIRS[cache_dir]
+
+def evict_cache_file(cache_dir, filename):
+    cache = CACHE_DIRS[cache_dir]
+    cache['size'] -= cache['entries'].pop(filename)[1]
+    try:
+        os.remove(os.path.join(cache_dir, filename))
+    except FileNotFoundError:
+        # e.g. evicted by another process
+        pass
+    CACHE_STATS['evictions'] += 1
+
+def write_cache_file(cache_file, columns):
+    cache_dir, filename = os.path.split(cache_file)
+    prefix = filename.rsplit('.', 2)[0] + '.'
+    os.makedirs(cache_dir, exist_ok=True)
+    cache = cache_dir_entries(cache_dir)
+    tmp_file = cache_file + '.{}.tmp'.format(os.getpid())
+    with open(tmp_file, 'wb') as outfile:
+        np.savez(outfile, **columns)
+        size = outfile.tell()
+    os.replace(tmp_file, cache_file)
+    CACHE_STATS['writes'] += 1
+    if filename in cache['entries']:
+        cache['size'] -= cache['entries'][filename][1]
+    cache['entries'][filename] = [time.time(), size]
+    cache['size'] += size
+
+    # entries of older versions of the same file are never used again
+    for name in [name for name in cache['entries'] if name != filename and name.startswith(prefix)
+                 and name.count('.') == filename.count('.')]:
+        evict_cache_file(cache_dir, name)
+
+    # least recently used entries first
+    if cache['size'] > CACHE_SETTINGS['max_size']:
+        for name, _ in sorted(cache['entries'].items(), key=lambda item: item[1][0]):
+            if cache['size'] <= CACHE_SETTINGS['max_size']:
+                break
+            if name != filename:
+                evict_cache_file(cache_dir, name)
+
+
+# In[ ]:
+
+
+def cached(files, kind, read, encode, decode, folder=False):
+    # read() is only called on a cache miss, encode/decode convert to and from a dict of numpy arrays
+    # folder keys the cache on the names of the files and their directories, see get_cache_file
+    if not CACHE_SETTINGS['enabled']:
+        return read()
+    if not isinstance(files, list):
+        files = [files]
+
+    if folder:
+        # the sidecar directory itself would change the mtime of the directory after the first write
+        try:
+            os.makedirs(os.path.join(os.path.dirname(files[0]), CACHE_DIRNAME), exist_ok=True)
+        except OSError:
+            # e.g. read-only result directories, reported when writing
+            pass
+    try:
+        cache_file = get_cache_file(files, kind, folder)
+    except FileNotFoundError:
+        # reported by read
+        return read()
+
+    try:
+        data = decode(load_cache_file(cache_file))
+        CACHE_STATS['hits'] += 1
+        return data
+    except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile):
+        pass
+
+    CACHE_STATS['misses'] += 1
+    data = read()
+    try:
+        write_cache_file(cache_file, encode(data))
+    except OSError as exce:
+        # e.g. read-only result directories
+        rprint('Not caching {} - {}'.format(cache_file, exce), file=sys.stderr)
+    return data
+
+
+# In[ ]:
+
+
+# run dicts indexed by (device id, direction, metric), see util.moongen
+def encode_run(run):
+    return {'{}|{}|{}'.format(*key): np.asarray(value) for key, value in run.items()}
+
+def decode_run(columns):
+    run = dict()
+    for key, value in columns.items():
+        cid, direction, metric = key.split('|')
+        if cid.isdigit():
+            cid = int(cid)
+        run[(cid, direction, metric)] = value if value.ndim else value.item()
+    return run
+
+# dicts of numbers, e.g. latency -> occurence
+def encode_dict(data):
+    return {'keys': np.fromiter(data.keys(), dtype=np.int64, count=len(data)),
+            'values': np.fromiter(data.values(), dtype=np.int64, count=len(data))}
+
+def decode_dict(columns):
+    return dict(zip(columns['keys'].tolist(), columns['values'].tolist()))
+
+# anything json serializable, e.g. loop variables
+def encode_json(data):
+    return {'json': np.asarray(json.dumps(data))}
+
+def decode_json(columns):
+    return json.loads(columns['json'].item())
+
+
@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+
+
+import os
+import atexit
+import multiprocessing
+import json
+import hashlib
+import itertools
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import matplotlib
+import matplotlib.pyplot as plt
+import matplotlib.ticker as ticker
+from matplotlib.colors import LogNorm
+from matplotlib.figure import Figure as MatplotlibFigure
+from util.tumcolor import tumcolor_cycler, tumcolor_cmap
+from util.i8_tikzplotlib import TIKZ_SETTINGS, save_plt, save_pgfplot, replacing
+rprint=print
+from pprint import pprint as print
+
+
+# In[ ]:
+
+
+# backend of the .tex files: pgfplots writes them straight from the data, tikzplotlib converts the drawn figure
+# preview draws the figure with matplotlib and shows it, None for only in notebooks (inline backend)
+# cache skips figures whose data and rendering did not change since they were written
+FIGURE_SETTINGS = {
+    'backend': 'pgfplots',
+    'preview': None,
+    'cache'  : True,
+}
+FIGURE_BACKENDS = ['pgfplots', 'tikzplotlib']
+FIGURE_STATS = {
+    'written'  : 0,
+    'unchanged': 0,
+}
+
+def configure_figures(backend=None, preview=None, cache=None):
+    if backend is not None:
+        FIGURE_SETTINGS['backend'] = backend
+    if preview is not None:
+        FIGURE_SETTINGS['preview'] = preview
+    if cache is not None:
+        FIGURE_SETTINGS['cache'] = cache
+
+def print_figure_stats():
+    rprint('Figures: {written} written, {unchanged} unchanged'.format(**FIGURE_STATS))
+
+def previews():
+    if FIGURE_SETTINGS['preview'] is None:
+        return 'inline' in matplotlib.get_backend()
+    return FIGURE_SETTINGS['preview']
+
+def new_figure(figsize):
+    # pyplot only for previews, otherwise a figure without global state that is garbage collected when done
+    if previews():
+        return plt.figure(figsize=figsize)
+    return MatplotlibFigure(figsize=figsize)
+
+
+# In[ ]:
+
+
+class Figure:
+    # the data of one axis of the fixed plot types, written as pgfplots or drawn with matplotlib
+    # the setters follow the matplotlib axes, lines take the next style of tumcolor_cycler like ax.plot
+    def __init__(self, xlabel='', ylabel='', title=None, figsize=(9,6), legend=None):
+        self.xlabel = xlabel
+        self.ylabel = ylabel
+        self.title = title
+        self.figsize = figsize
+        # (loc, bbox_to_anchor) of the legend, None without legend
+        self.legend = legend
+        self.xlim = [None, None]
+        self.ylim = [None, None]
+        self.xscale = 'linear'
+        self.yscale = 'linear'
+        self.xticks = None
+        self.lines = []
+        self.bands = []
+        self.boxes = []
+        self.box_style = {'edge': 'TUMBlack', 'face': 'TUMWhite', 'median': 'TUMOrange'}
+        self.images = []
+        self.styles = itertools.cycle(tumcolor_cycler)
+
+    def line(self, xs, ys, label=None, style=None, steps=False, marker=None, markersize=6, linestyle=None):
+        # returns the style of the line, e.g. for a band of the same color
+        style = dict(next(self.styles) if style is None else style)
+        if linestyle is not None:
+            style['linestyle'] = linestyle
+        self.lines.append({'xs': np.asarray(xs, dtype=np.float64), 'ys': np.asarray(ys, dtype=np.float64),
+                           'label': label, 'style': style, 'steps': steps, 'marker': marker,
+                           'markersize': markersize})
+        return style
+
+    def band(self, xs, lower, upper, style):
+        self.bands.append((np.asarray(xs, dtype=np.float64), np.asarray(lower, dtype=np.float64),
+                           np.asarray(upper, dtype=np.float64), style))
+
+    def boxplot(self, stats):
+        # statistics of Histogram.box_stats, drawn at 1, 2, ...
+        self.boxes += stats
+
+    def image(self, image, extent, cmap=tumcolor_cmap):
+        # counts colored on a log scale, zero is transparent, the axis fits the extent like imshow
+        self.images.append((image, extent, cmap))
+        self.set_xlim(*extent[:2])
+        self.set_ylim(*extent[2:])
+
+    def set_xlim(self, left=None, right=None):
+        self.xlim = [self.xlim[0] if left is None else left, self.xlim[1] if right is None else right]
+
+    def set_ylim(self, bottom=None, top=None):
+        self.ylim = [self.ylim[0] if bottom is None else bottom, self.ylim[1] if top is None else top]
+
+    def set_xscale(self, scale):
+        self.xscale = scale
+
+    def set_yscale(self, scale):
+        self.yscale = scale
+
+    def set_xticks(self, ticks, labels):
+        # without minor ticks
+        self.xticks = (list(ticks), list(labels))
+
+    def draw(self, ax):
+        for image, extent, cmap in self.images:
+            ax.imshow(np.ma.masked_equal(image, 0), origin='lower', aspect='auto', extent=extent,
+                      interpolation='nearest', cmap=cmap, norm=LogNorm())
+        for xs, lower, upper, style in self.bands:
+            ax.fill_between(xs, lower, upper, color=style['color'], alpha=0.3, linewidth=0)
+        for line in self.lines:
+            kwargs = dict(line['style'])
+            if line['steps']:
+                kwargs['drawstyle'] = 'steps-post'
+            if line['marker']:
+                kwargs.update(marker=line['marker'], markersize=line['markersize'])
+            ax.plot(line['xs'], line['ys'], label=line['label'], **kwargs)
+        if self.boxes:
+            ax.bxp(self.boxes, showfliers=True, patch_artist=True,
+                   medianprops=dict(color=self.box_style['median']),
+                   boxprops=dict(facecolor=self.box_style['face'], edgecolor=self.box_style['edge']))
+        ax.set_xscale(self.xscale)
+        ax.set_yscale(self.yscale)
+        if self.xticks is not None:
+            ax.set_xticks(*self.xticks)
+            ax.xaxis.set_minor_locator(ticker.NullLocator())
+        ax.set_xlim(*self.xlim)
+        ax.set_ylim(*self.ylim)
+        ax.grid()
+        ax.set(xlabel=self.xlabel, ylabel=self.ylabel)
+        if self.title is not None:
+            ax.set_title(self.title)
+        if self.legend is not None:
+            loc, anchor = self.legend
+            ax.legend(loc=loc, bbox_to_anchor=anchor)
+
+    def __getstate__(self):
+        # the style cycle is only needed while adding lines, not to write the figure in another process
+        state = dict(vars(self))
+        del state['styles']
+        return state
+
+    def render(self):
+        fig = new_figure(self.figsize)
+        self.draw(fig.subplots())
+        return fig
+
+    def content(self):
+        # everything that is drawn, colormaps by name
+        content = {key: value for key, value in vars(self).items() if key not in ['styles', 'images']}
+        content['images'] = [(image, extent, cmap.name) for image, extent, cmap in self.images]
+        return content
+
+    def save(self, filepath, name='', exports=None):
+        output = 'figures/{}.tex'.format('{}-{}'.format(name, filepath) if name else filepath)
+        digest = figure_digest(self.content(), filepath, name, exports, FIGURE_SETTINGS['backend'],
+                               TIKZ_SETTINGS['max_points'])
+        if not cached_figure(output, digest, self.write, filepath, name, exports) and previews():
+            finish(self.render(), filepath, name)
+
+    def write(self, filepath, name='', exports=None):
+        # the .tex and every additional export from at most one matplotlib figure, returns the written files
+        fig = None
+        if exports or previews() or FIGURE_SETTINGS['backend'] == 'tikzplotlib':
+            fig = self.render()
+        if FIGURE_SETTINGS['backend'] == 'tikzplotlib':
+            files = save_plt(filepath, name=name, figure=fig)
+        else:
+            files = save_pgfplot(self, filepath, name=name)
+        if fig is not None:
+            files += finish(fig, filepath, name, exports)
+        return files
+
+def finish(fig, filepath, name='', exports=None):
+    # additional exports as figures/<name>_<filepath>.<format>, then shown in notebooks
+    files = []
+    for ape in exports or []:
+        rprint('Additional export as {}'.format(ape))
+        files.append('figures/{}_{}.{}'.format(name, filepath, ape))
+        with replacing(files[-1]) as tmp_file:
+            fig.savefig(tmp_file, format=ape)
+    if previews():
+        plt.show()
+    return files
+
+
+# In[ ]:
+
+
+# figures saved while a pool is open are written by its processes, see figure_pool
+FIGURE_POOL = {
+    'processes': 0,    # of the open pool, 0 without one
+    'executor' : None, # started once enough figures are waiting, with at most one process per figure
+    'pending'  : {},   # output -> (digest, future or (write, args) until it is started)
+}
+
+def configure_worker(figure_settings, tikz_settings):
+    # headless, the worker never shows figures
+    matplotlib.use('Agg')
+    FIGURE_SETTINGS.update(figure_settings)
+    TIKZ_SETTINGS.update(tikz_settings)
+
+@contextmanager
+def figure_pool(processes=None):
+    # independent figures, e.g. of all groups and metrics, are written in parallel, all are written when the block ends
+    # one process (or previews, which need the main process) writes every figure right away as before
+    # workers are forked, the scripts run their command line on import and must not be imported again
+    processes = processes or os.cpu_count() or 1
+    if (processes < 2 or previews() or FIGURE_POOL['processes']
+            or 'fork' not in multiprocessing.get_all_start_methods()):
+        try:
+            yield
+        finally:
+            write_manifest()
+        return
+    FIGURE_POOL['processes'] = processes
+    try:
+        yield
+        wait_figures()
+    finally:
+        if FIGURE_POOL['executor'] is not None:
+            # figures not started yet are dropped after an error, shutdown has no cancel_futures before python 3.9
+            for _, job in FIGURE_POOL['pending'].values():
+                if not isinstance(job, tuple):
+                    job.cancel()
+            FIGURE_POOL['executor'].shutdown(wait=True)
+        FIGURE_POOL.update(processes=0, executor=None, pending={})
+        write_manifest()
+
+def start_figures(queued=None):
+    # submits the waiting figures, the pool is only started for two or more
+    pending = FIGURE_POOL['pending']
+    if queued is None:
+        queued = [output for output, (_, job) in pending.items() if isinstance(job, tuple)]
+    if FIGURE_POOL['executor'] is None:
+        if len(queued) < 2:
+            return
+        settings = (dict(FIGURE_SETTINGS, preview=False), dict(TIKZ_SETTINGS))
+        FIGURE_POOL['executor'] = ProcessPoolExecutor(min(FIGURE_POOL['processes'], len(queued)),
+                                                      mp_context=multiprocessing.get_context('fork'),
+                                                      initializer=configure_worker, initargs=settings)
+    for output in queued:
+        digest, (write, args) = pending[output]
+        pending[output] = (digest, FIGURE_POOL['executor'].submit(write, *args))
+
+def wait_figures(outputs=None):
+    pending = FIGURE_POOL['pending']
+    start_figures()
+    written = {}
+    for output in list(pending if outputs is None else outputs):
+        digest, job = pending.pop(output)
+        written[output] = (digest, job[0](*job[1]) if isinstance(job, tuple) else job.result())
+    record_figures(written)
+
+
+# In[ ]:
+
+
+# the manifest lists the digest and the written files of every figure in figures/ and data/
+# and every file ever written for a figure, which are stale once no figure lists them
+FIGURE_MANIFEST = 'figures/.manifest.json'
+MANIFEST_STATE = {
+    'manifest': None, # {'figures': {output: {'digest', 'files'}}, 'files': set of written files}
+    'path'    : None,
+    'changed' : False,
+}
+# bump the version whenever a writer produces something different for the same figure
+FIGURE_CACHE_VERSION = 1
+
+def figure_digest(*parts):
+    # of numbers, strings, arrays and lists, tuples and dicts of them
+    digest = hashlib.sha1(str(FIGURE_CACHE_VERSION).encode())
+    def update(part):
+        if isinstance(part, np.ndarray):
+            digest.update('array {} {}'.format(part.dtype, part.shape).encode())
+            digest.update(np.ascontiguousarray(part).tobytes())
+        elif isinstance(part, dict):
+            digest.update(b'dict')
+            for key in sorted(part, key=str):
+                update(key)
+                update(part[key])
+        elif isinstance(part, (list, tuple)):
+            digest.update('list {}'.format(len(part)).encode())
+            for item in part:
+                update(item)
+        else:
+            digest.update(repr(part).encode() + b'\0')
+    update(parts)
+    return digest.hexdigest()
+
+def load_manifest():
+    # once per process, changes are kept in memory until write_manifest
+    if MANIFEST_STATE['manifest'] is None:
+        try:
+            with open(FIGURE_MANIFEST) as infile:
+                manifest = json.load(infile)
+        except (OSError, ValueError):
+            manifest = {}
+        MANIFEST_STATE['manifest'] = {'figures': manifest.get('figures', {}), 'files': set(manifest.get('files', []))}
+        MANIFEST_STATE['path'] = os.path.abspath(FIGURE_MANIFEST)
+        # figures saved without a pool, e.g. in notebooks, are recorded when the process ends
+        atexit.register(write_manifest)
+    return MANIFEST_STATE['manifest']
+
+def write_manifest():
+    if not MANIFEST_STATE['changed']:
+        return
+    manifest = MANIFEST_STATE['manifest']
+    with replacing(MANIFEST_STATE['path']) as tmp_file, open(tmp_file, 'w') as outfile:
+        json.dump({'figures': manifest['figures'], 'files': sorted(manifest['files'])}, outfile, indent=1,
+                  sort_keys=True)
+    MANIFEST_STATE['changed'] = False
+
+def record_figures(written):
+    # {output: (digest, files)} of written figures, the manifest is only changed by the main process
+    # also without the cache, the written files are never stale
+    FIGURE_STATS['written'] += len(written)
+    if not written:
+        return
+    manifest = load_manifest()
+    for output, (digest, files) in written.items():
+        manifest['figures'][output] = {'digest': digest, 'files': sorted(set(files))}
+        manifest['files'].update(files)
+    MANIFEST_STATE['changed'] = True
+
+def cached_figure(output, digest, write, *args):
+    # write(*args) is only called if the figure changed or one of its files is gone, in the pool if there is one
+    # returns if it was called, write and args have to be picklable for the pool
+    pending = FIGURE_POOL['pending']
+    if output in pending:
+        if pending[output][0] == digest:
+            FIGURE_STATS['unchanged'] += 1
+            return False
+        # the same file with other data, e.g. a metric given twice
+        wait_figures([output])
+    if FIGURE_SETTINGS['cache']:
+        entry = load_manifest()['figures'].get(output)
+        if (entry is not None and entry['digest'] == digest
+                and all(os.path.exists(path) for path in entry['files'])):
+            FIGURE_STATS['unchanged'] += 1
+            rprint('Unchanged ' + output)
+            return False
+    if FIGURE_POOL['processes']:
+        # waits until there are as many figures as processes, the last ones at the end of the block
+        pending[output] = (digest, (write, args))
+        if FIGURE_POOL['executor'] is not None:
+            start_figures([output])
+        elif len(pending) >= FIGURE_POOL['processes']:
+            start_figures()
+        return True
+    record_figures({output: (digest, write(*args))})
+    return True
+
+def stale_artifacts():
+    # files once written for a figure that no figure of the manifest lists anymore, e.g. of an older backend,
+    # files not written by these scripts are never stale
+    manifest = load_manifest()
+    listed = {path for entry in manifest['figures'].values() for path in entry['files']}
+    return sorted(path for path in manifest['files'] - listed if os.path.isfile(path))
+
+def prune_artifacts():
+    # removes stale files and forgets them and figures whose files are gone
+    for path in stale_artifacts():
+        os.remove(path)
+        rprint('Removed ' + path)
+    manifest = load_manifest()
+    manifest['figures'] = {output: entry for output, entry in manifest['figures'].items()
+                           if all(os.path.exists(path) for path in entry['files'])}
+    manifest['files'] = {path for entry in manifest['figures'].values() for path in entry['files']}
+    MANIFEST_STATE['changed'] = True
+    write_manifest()
+
+
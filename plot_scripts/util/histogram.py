@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+
+
+import math
+import numpy as np
+
+
+# In[ ]:
+
+
+# treat negative (>1.0) and exact 1.0 values and very high values for the hdr
+MAX_ACCURACY = 1000000000
+# relative error of the log bucketed histogram, 3 digits are at most 0.1%
+HDR_SIGNIFICANT_DIGITS = 3
+# coarser levels of the bin pyramid, in the unit of the raw values (e.g. ns)
+PYRAMID_WIDTHS = [10, 100, 1000, 10000]
+
+
+# In[ ]:
+
+
+class Histogram:
+    # sorted unique values (e.g. latency in ns) and their counts, every transformation works on whole arrays
+    # derived histograms (normalized, cdf, hdr) keep the values but have float counts
+    # unit converts the integer values to the plotted unit, e.g. 1000 for ns to microsecond
+    def __init__(self, values, counts, unit=1):
+        self.values = values
+        self.counts = counts
+        self.unit = unit
+
+    @classmethod
+    def from_pairs(cls, values, counts, unit=1):
+        # unsorted values, occurences of the same value are added
+        values = np.asarray(values)
+        counts = np.asarray(counts)
+        order = np.argsort(values, kind='stable')
+        values = values[order]
+        counts = counts[order]
+        starts = np.flatnonzero(np.concatenate([[True], values[1:] != values[:-1]]))
+        if len(starts) >= len(values):
+            return cls(values, counts, unit)
+        return cls(values[starts], np.add.reduceat(counts, starts), unit)
+
+    @classmethod
+    def from_dict(cls, data, unit=1):
+        return cls.from_pairs(np.fromiter(data.keys(), dtype=np.float64, count=len(data)),
+                              np.fromiter(data.values(), dtype=np.float64, count=len(data)), unit)
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def xs(self):
+        # values in the plotted unit
+        if self.unit == 1:
+            return self.values
+        return self.values / self.unit
+
+    @property
+    def total(self):
+        return self.counts.sum()
+
+    def to_unit(self, unit):
+        return Histogram(self.values, self.counts, unit)
+
+    def rebin(self, width):
+        # exact integer binning, values are rounded to the closest multiple of width (half up)
+        if width <= 1 or not len(self):
+            return self
+        values = (self.values + width // 2) // width * width
+        starts = np.flatnonzero(np.concatenate([[True], values[1:] != values[:-1]]))
+        return Histogram(values[starts], np.add.reduceat(self.counts, starts), self.unit)
+
+    def normalize(self):
+        return Histogram(self.values, self.counts / self.total, self.unit)
+
+    def cdf(self):
+        return Histogram(self.values, np.cumsum(self.counts) / self.total, self.unit)
+
+    def hdr(self):
+        # only for a cdf, counts are converted to 1/(1-p), e.g. 100 for the 99th percentile
+        with np.errstate(divide='ignore'):
+            inverse = 1 / (1 - self.counts)
+        valid = (self.counts < 1) & (inverse <= MAX_ACCURACY)
+        return Histogram(self.values[valid], inverse[valid], self.unit)
+
+    def steps(self, width):
+        # outline of bars of the given width as one steps-post line, dropping to zero between separated bars
+        xs = self.xs
+        if not len(xs):
+            return xs, self.counts
+        lefts = xs - width / 2
+        rights = xs + width / 2
+        separated = np.append(lefts[1:] - rights[:-1] > width * 1e-6, True)
+        points = np.stack([lefts, rights], axis=1)
+        values = np.stack([self.counts, np.zeros_like(self.counts)], axis=1)
+        used = np.stack([np.ones_like(separated), separated], axis=1)
+        return np.append(lefts[0], points[used]), np.append(0, values[used])
+
+    def percentile(self, q):
+        # same as np.percentile (linear) of one value per occurence, without expanding the histogram
+        if not len(self):
+            raise IndexError('percentile of an empty histogram')
+        xs = self.xs
+        ends = np.cumsum(self.counts)
+        index = (ends[-1] - 1) * (np.asarray(q, dtype=np.float64) / 100)
+        below = np.floor(index)
+        gamma = index - below
+        lower = xs[np.searchsorted(ends, below, side='right')]
+        upper = xs[np.searchsorted(ends, np.minimum(below + 1, ends[-1] - 1), side='right')]
+        diff = upper - lower
+        return np.where(gamma >= 0.5, upper - diff * (1 - gamma), lower + diff * gamma)[()]
+
+    def box_stats(self, whis=1.5, label=None):
+        # statistics of matplotlib.cbook.boxplot_stats for ax.bxp, fliers are the distinct outlying values
+        stats = {'label': label}
+        if not len(self):
+            stats.update({key: np.nan for key in ['mean', 'med', 'q1', 'q3', 'iqr', 'cilo', 'cihi',
+                                                  'whislo', 'whishi']})
+            stats['fliers'] = np.array([])
+            return stats
+        xs = self.xs
+        total = self.total
+        q1, med, q3 = self.percentile([25, 50, 75])
+        iqr = q3 - q1
+        low = xs[xs >= q1 - whis * iqr]
+        high = xs[xs <= q3 + whis * iqr]
+        whislo = q1 if not len(low) or low[0] > q1 else low[0]
+        whishi = q3 if not len(high) or high[-1] < q3 else high[-1]
+        stats.update({
+            'mean'  : np.sum(xs * self.counts) / total,
+            'med'   : med,
+            'q1'    : q1,
+            'q3'    : q3,
+            'iqr'   : iqr,
+            'cilo'  : med - 1.57 * iqr / np.sqrt(total),
+            'cihi'  : med + 1.57 * iqr / np.sqrt(total),
+            'whislo': whislo,
+            'whishi': whishi,
+            'fliers': xs[(xs < whislo) | (xs > whishi)],
+        })
+        return stats
+
+
+# In[ ]:
+
+
+class BinPyramid:
+    # the raw histogram (width 1) and coarser levels binned by the floor of value / width
+    # rounding to a width is served from the coarsest level whose width divides half of it,
+    # which gives exactly the same bins as rebinning the raw histogram
+    def __init__(self, levels):
+        self.levels = levels
+
+    @classmethod
+    def from_histogram(cls, hist, widths=PYRAMID_WIDTHS):
+        # every level is aggregated from the previous one
+        levels = {1: hist}
+        previous = hist
+        for width in sorted(widths):
+            if len(previous):
+                values = previous.values // width * width
+                starts = np.flatnonzero(np.concatenate([[True], values[1:] != values[:-1]]))
+                previous = Histogram(values[starts], np.add.reduceat(previous.counts, starts), hist.unit)
+            levels[width] = previous
+        return cls(levels)
+
+    @property
+    def raw(self):
+        return self.levels[1]
+
+    def level_for(self, width):
+        return max([level for level in self.levels if width % (2 * level) == 0], default=1)
+
+    def rebin(self, width):
+        return self.levels[self.level_for(width)].rebin(width)
+
+
+# In[ ]:
+
+
+class LogHistogram:
+    # HdrHistogram style buckets: exact below 2**bits, above that every power of two is split into
+    # 2**(bits-1) linear buckets, so the relative error stays below 10**-significant_digits
+    # counts is dense over the bucket indices, merging is a single addition of two arrays
+    def __init__(self, counts, significant_digits=HDR_SIGNIFICANT_DIGITS, unit=1):
+        self.counts = counts
+        self.significant_digits = significant_digits
+        self.unit = unit
+        self.bits = int(math.ceil(significant_digits * math.log2(10))) + 1
+
+    @classmethod
+    def from_histogram(cls, hist, significant_digits=HDR_SIGNIFICANT_DIGITS):
+        log = cls(np.zeros(0, dtype=np.int64), significant_digits, hist.unit)
+        if len(hist):
+            indices = log.bucket_index(hist.values)
+            log.counts = np.bincount(indices, weights=hist.counts).astype(np.int64)
+        return log
+
+    @classmethod
+    def from_values(cls, values, significant_digits=HDR_SIGNIFICANT_DIGITS, unit=1):
+        # one occurence per value
+        log = cls(np.zeros(0, dtype=np.int64), significant_digits, unit)
+        if len(values):
+            log.counts = np.bincount(log.bucket_index(values))
+        return log
+
+    def __len__(self):
+        return len(self.counts)
+
+    @property
+    def total(self):
+        return self.counts.sum()
+
+    def to_unit(self, unit):
+        return LogHistogram(self.counts, self.significant_digits, unit)
+
+    def bucket_index(self, values):
+        values = np.asarray(values, dtype=np.int64)
+        if (values < 0).any():
+            raise ValueError('negative values can not be recorded')
+        size = 1 << self.bits
+        # frexp returns the bit length of the integer values as exponent
+        shift = np.maximum(np.frexp(values)[1] - self.bits, 0)
+        return np.where(shift == 0, values, size + (shift - 1) * (size >> 1) + (values >> shift) - (size >> 1))
+
+    def bucket_bounds(self, indices):
+        # lowest and highest value falling into the buckets
+        size = 1 << self.bits
+        indices = np.asarray(indices, dtype=np.int64)
+        shift = np.where(indices < size, 0, (indices - size) // (size >> 1) + 1)
+        mantissa = np.where(indices < size, indices, (indices - size) % (size >> 1) + (size >> 1))
+        lowest = mantissa << shift
+        return lowest, lowest + (1 << shift) - 1
+
+    def merge(self, other):
+        if not (self.significant_digits == other.significant_digits and self.unit == other.unit):
+            raise ValueError('can only merge histograms with the same significant digits and unit')
+        counts = np.zeros(max(len(self), len(other)), dtype=np.int64)
+        counts[:len(self)] += self.counts
+        counts[:len(other)] += other.counts
+        return LogHistogram(counts, self.significant_digits, self.unit)
+
+    def to_histogram(self):
+        # one value per used bucket, the middle of the bucket
+        indices = np.flatnonzero(self.counts)
+        lowest, highest = self.bucket_bounds(indices)
+        return Histogram(lowest + (highest - lowest + 1) // 2, self.counts[indices], self.unit)
+
+    def percentile(self, q):
+        return self.to_histogram().percentile(q)
+
+    def hdr(self):
+        # 1/(1-p) from the remaining counts instead of the float cdf, the tail is not cut off at MAX_ACCURACY
+        # every bucket is represented by its highest value, p of all values are at most that high
+        indices = np.flatnonzero(self.counts)
+        _, highest = self.bucket_bounds(indices)
+        counts = self.counts[indices]
+        remaining = counts.sum() - np.cumsum(counts)
+        valid = remaining > 0
+        return Histogram(highest[valid], counts.sum() / remaining[valid], self.unit)
+
+
+# In[ ]:
+
+
+def read_histogram(exp, unit=1):
+    # two columns: value, occurence
+    with open(exp) as infile:
+        content = infile.read()
+    data = np.fromstring(content.replace(',', ' '), dtype=np.int64, sep=' ').reshape(-1, 2)
+    return Histogram.from_pairs(data[:, 0], data[:, 1], unit)
+
+def to_histogram(data):
+    # plot functions also accept the old {value: occurence} dicts
+    if isinstance(data, Histogram):
+        return data
+    if isinstance(data, LogHistogram):
+        return data.to_histogram()
+    return Histogram.from_dict(data)
+
+def encode_histogram(hist):
+    return {'values': hist.values, 'counts': hist.counts, 'unit': np.asarray(hist.unit)}
+
+def decode_histogram(columns):
+    return Histogram(columns['values'], columns['counts'], columns['unit'].item())
+
+def encode_log_histogram(log):
+    return {'counts': log.counts, 'significant_digits': np.asarray(log.significant_digits),
+            'unit': np.asarray(log.unit)}
+
+def decode_log_histogram(columns):
+    return LogHistogram(columns['counts'], columns['significant_digits'].item(), columns['unit'].item())
+
+def encode_pyramid(pyramid):
+    columns = {'unit': np.asarray(pyramid.raw.unit)}
+    for width, hist in pyramid.levels.items():
+        columns['values_{}'.format(width)] = hist.values
+        columns['counts_{}'.format(width)] = hist.counts
+    return columns
+
+def decode_pyramid(columns):
+    unit = columns['unit'].item()
+    widths = [int(key.split('_')[1]) for key in columns if key.startswith('values_')]
+    return BinPyramid({width: Histogram(columns['values_{}'.format(width)], columns['counts_{}'.format(width)], unit)
+                       for width in widths})
+
+
@@ -8,6 +8,12 @@ import os
 rprint=print
 from pprint import pprint as print
 import codecs
+from contextlib import contextmanager
+from glob import glob, escape
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
+from matplotlib.image import imsave
 import tikzplotlib
 
 
@@ -59,6 +65,54 @@ tikz_footer = r"""
 \end{document}
 """
 
+# points of all lines of a figure written to the tables, tex runs out of memory with too many of them
+TIKZ_SETTINGS = {
+    'max_points': 20000,
+}
+
+def configure_tikz(max_points=None):
+    if max_points is not None:
+        TIKZ_SETTINGS['max_points'] = max_points
+
+def decimate(ys, points):
+    # indices of the first, last, lowest and highest point of every bucket of consecutive points (M4),
+    # keeps the shape and all extremes with at most points indices
+    n = len(ys)
+    buckets = np.arange(n) * max(1, points // 4) // n
+    starts = np.flatnonzero(np.concatenate([[True], buckets[1:] != buckets[:-1]]))
+    ends = np.append(starts[1:], n) - 1
+    order = np.lexsort((ys, buckets))
+    return np.unique(np.concatenate([starts, ends, order[starts], order[ends]]))
+
+def limit_lines(lines, max_points):
+    # (xs, ys) of all lines within the budget, every line gets a share of it by its number of points
+    total = sum(len(ys) for _, ys in lines)
+    if total <= max_points:
+        return lines
+    limited = []
+    for xs, ys in lines:
+        share = max_points * len(ys) // total
+        if len(ys) > max(4, share):
+            keep = decimate(ys, share)
+            xs, ys = xs[keep], ys[keep]
+        limited.append((xs, ys))
+    rprint('Dropped {} of {} points to stay below {} points'.format(
+        total - sum(len(ys) for _, ys in limited), total, max_points))
+    return limited
+
+def limit_points(figure, max_points):
+    # same for the lines of a matplotlib figure, the figure is changed in place
+    lines = [line for ax in figure.axes for line in ax.get_lines()
+             if np.issubdtype(np.asarray(line.get_ydata()).dtype, np.number)]
+    data = [(np.asarray(line.get_xdata()), np.asarray(line.get_ydata())) for line in lines]
+    for line, (xs, ys), (_, old) in zip(lines, limit_lines(data, max_points), data):
+        if len(ys) < len(old):
+            line.set_data(xs, ys)
+
+
+# In[ ]:
+
+
 # replace mpl definitions and exports of tumcolors with actual tumcolors
 # add data/ to all tsv paths
 def post_process(code):
@@ -82,6 +136,9 @@ def post_process(code):
         # look for externalized tsvs
         if '.tsv};' in line:
             line = 'data/' + line
+        # and externalized images
+        if line.startswith('\\addplot graphics') and '.png};' in line:
+            line = line.replace('] {', '] {data/')
         new_code.append(line) 
     return '\n'.join(new_code)
 
@@ -90,7 +147,10 @@ def post_process(code):
 # newer commit already allow context manipulation, but not yet deployed with pip
 # we also do some other magic in post proessing
 def get_tikz_code(*args, axis_width='10cm', axis_height='5cm',
-                  clean_figure=False, target_resolution=600, scale_precision=1.0, **kwargs):
+                  clean_figure=False, target_resolution=600, scale_precision=1.0, max_points=None, **kwargs):
+    figure = kwargs.get('figure', 'gcf')
+    limit_points(plt.gcf() if figure == 'gcf' else figure,
+                 TIKZ_SETTINGS['max_points'] if max_points is None else max_points)
     if clean_figure:
         tikzplotlib.clean_figure(target_resolution=target_resolution,
                                  scale_precision=scale_precision)
@@ -119,10 +179,9 @@ def save_plt(filepath, *args, name='', encoding=None, **kwargs):
     filepath = 'data/' + filepath_neutral
     filepath_end = 'figures/' + filepath_neutral
     
-    if not os.path.exists('data'):
-        os.makedirs('data')
-    if not os.path.exists('figures'):
-        os.makedirs('figures')
+    # several processes may create them at once
+    os.makedirs('data', exist_ok=True)
+    os.makedirs('figures', exist_ok=True)
     
     code = get_tikz_code(*args, filepath=filepath, **kwargs)
     with codecs.open(filepath, "w", encoding) as fh:
@@ -131,5 +190,239 @@ def save_plt(filepath, *args, name='', encoding=None, **kwargs):
     # move this .tex back to parent (from data/)
     os.rename(filepath, filepath_end)
     rprint('Generated ' + filepath_end)
-    return
+    # all written files, tikzplotlib numbers the tables and images of a figure
+    return [filepath_end] + sorted(glob(escape(filepath[:-len('.tex')]) + '-[0-9][0-9][0-9].*'))
+
+
+# In[ ]:
+
+
+# matplotlib line styles and widths as pgfplots options, like tikzplotlib one pt per point of linewidth
+PGF_LINESTYLES = {'-': 'solid', '--': 'dashed', '-.': 'dashdotted', ':': 'dotted'}
+# matplotlib markers and legend locations, marker sizes are diameters, pgfplots mark sizes radii
+PGF_MARKS = {'o': '*', 'x': 'x', '+': '+', '*': 'asterisk', 's': 'square*', '^': 'triangle*'}
+PGF_ANCHORS = {'upper left': 'north west', 'center left': 'west', 'lower left': 'south west',
+               'upper right': 'north east', 'center right': 'east', 'lower right': 'south east'}
+
+def to_tex(text):
+    return str(text).replace('_', '\\_')
+
+def pgf_style(style):
+    options = ['line width={:g}pt'.format(style.get('linewidth', 1)), style['color']]
+    if style.get('linestyle', '-') != '-':
+        options.append(PGF_LINESTYLES.get(style['linestyle'], 'solid'))
+    return options
+
+def pgf_header(libraries):
+    if not libraries:
+        return tikz_header
+    return tikz_header.replace('\\usepackage{pgfplots}\n',
+                               '\\usepackage{pgfplots}\n\\usepgfplotslibrary{%s}\n' % ','.join(libraries))
+
+def make_output_dirs():
+    # tsv and png files end up in data/, the .tex in figures/
+    for directory in ['data', 'figures']:
+        os.makedirs(directory, exist_ok=True)
+
+@contextmanager
+def replacing(filepath):
+    # written under a temporary name of this process and renamed when complete, figures written in parallel
+    # never see partial or interleaved files
+    tmp_file = '{}.{}.tmp'.format(filepath, os.getpid())
+    try:
+        yield tmp_file
+        os.replace(tmp_file, filepath)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+def write_table(filepath, columns, encoding=None):
+    # one column per array, shorter columns are padded with nan which pgfplots discards
+    rows = max([len(values) for values in columns.values()] or [0])
+    table = np.full((rows, len(columns)), np.nan)
+    for i, values in enumerate(columns.values()):
+        table[:len(values), i] = values
+    with replacing(filepath) as tmp_file, codecs.open(tmp_file, 'w', encoding) as fh:
+        fh.write('\t'.join(columns) + '\n')
+        np.savetxt(fh, table, fmt='%.15g', delimiter='\t')
+
+# one groupplot of all facets with a single table in data/, instead of one figure per facet
+# facets are (title, series), series are (label, xs, ys, lower, upper, style), lower and upper may be None
+def save_groupplot(filepath, facets, xlabel='', ylabel='', name='', columns=3, encoding=None,
+                   facet_width='6cm', facet_height='4cm'):
+    if name:
+        name = name + '-'
+    filepath = '{}{}'.format(name, filepath)
+    make_output_dirs()
+
+    # one row per x value of any facet, one column per line and band, nan where a line has no value
+    xs = np.unique(np.concatenate([np.asarray(line[1], dtype=np.float64)
+                                   for _, series in facets for line in series] or [np.zeros(0)]))
+    table = {'x': xs}
+    for i, (_, series) in enumerate(facets):
+        for j, (_, line_xs, ys, lower, upper, _) in enumerate(series):
+            rows = np.searchsorted(xs, np.asarray(line_xs, dtype=np.float64))
+            for column, values in [('y', ys), ('lower', lower), ('upper', upper)]:
+                if values is None:
+                    continue
+                table['{}{}_{}'.format(column, i, j)] = np.full(len(xs), np.nan)
+                table['{}{}_{}'.format(column, i, j)][rows] = values
+    tsv = filepath + '.tsv'
+    write_table('data/' + tsv, table, encoding)
+
+    # every label once in the legend of the last facet, with the style of its first line
+    legend = {}
+    for _, series in facets:
+        for label, _, _, _, _, style in series:
+            legend.setdefault(label, style)
+
+    rows = (len(facets) + columns - 1) // columns
+    code = [r'\begin{tikzpicture}', r'\begin{groupplot}[',
+            'group style={{group size={} by {}, horizontal sep=1.5cm, vertical sep=2cm, '
+            'xlabels at=edge bottom, ylabels at=edge left}},'.format(min(columns, len(facets)), rows),
+            'width={}, height={},'.format(facet_width, facet_height),
+            'xlabel={{{}}}, ylabel={{{}}},'.format(to_tex(xlabel), to_tex(ylabel)),
+            'ymin=0, xmajorgrids, ymajorgrids, unbounded coords=discard,',
+            'legend cell align={left},',
+            ']']
+    for i, (title, series) in enumerate(facets):
+        options = ['title={{{}}}'.format(to_tex(title))]
+        if i == len(facets) - 1:
+            options.append('legend style={at={(1.05,0.5)}, anchor=west}')
+        code.append(r'\nextgroupplot[{}]'.format(', '.join(options)))
+        for j, (_, _, _, lower, upper, style) in enumerate(series):
+            if lower is not None:
+                for column in ['lower', 'upper']:
+                    code.append(r'\addplot [draw=none, forget plot, name path={0}{1}_{2}] '
+                                r'table [x=x, y={0}{1}_{2}] {{data/{3}}};'.format(column, i, j, tsv))
+                code.append(r'\addplot [fill={}, fill opacity=0.3, forget plot] '
+                            r'fill between [of=upper{}_{} and lower{}_{}];'.format(style['color'], i, j, i, j))
+            code.append(r'\addplot [{}, mark=x, mark size=3, mark options={{solid}}, forget plot] '
+                        r'table [x=x, y=y{}_{}] {{data/{}}};'.format(', '.join(pgf_style(style)), i, j, tsv))
+        if i == len(facets) - 1:
+            for label, style in legend.items():
+                code.append(r'\addlegendimage{{{}, mark=x, mark size=3, mark options={{solid}}}}'.format(
+                    ', '.join(pgf_style(style))))
+                code.append(r'\addlegendentry{{{}}}'.format(to_tex(label)))
+    code += [r'\end{groupplot}', r'\end{tikzpicture}']
+
+    filepath_end = 'figures/{}.tex'.format(filepath)
+    with replacing(filepath_end) as tmp_file, codecs.open(tmp_file, 'w', encoding) as fh:
+        fh.write('{}{}{}'.format(pgf_header(['groupplots', 'fillbetween']), '\n'.join(code), tikz_footer))
+    rprint('Generated ' + filepath_end)
+    return [filepath_end, 'data/' + tsv]
+
+
+# In[ ]:
+
+
+def pgf_number(value):
+    return '{:.15g}'.format(value)
+
+def pgf_axis_options(figure, axis_width, axis_height):
+    options = ['width={}, height={},'.format(axis_width, axis_height)]
+    if figure.title is not None:
+        options.append('title={{{}}},'.format(to_tex(figure.title)))
+    options.append('xlabel={{{}}}, ylabel={{{}}},'.format(to_tex(figure.xlabel), to_tex(figure.ylabel)))
+    for axis, limits in [('x', figure.xlim), ('y', figure.ylim)]:
+        for bound, value in zip(['min', 'max'], limits):
+            if value is not None:
+                options.append('{}{}={},'.format(axis, bound, pgf_number(value)))
+    for axis, scale in [('x', figure.xscale), ('y', figure.yscale)]:
+        if scale == 'log':
+            options.append('{}mode=log,'.format(axis))
+    if figure.xticks is not None:
+        ticks, labels = figure.xticks
+        options.append('xtick={{{}}}, minor xtick={{}},'.format(','.join(pgf_number(tick) for tick in ticks)))
+        options.append('xticklabels={{{}}},'.format(','.join('{{{}}}'.format(to_tex(label)) for label in labels)))
+    options.append('tick align=outside, tick pos=left,')
+    options.append('xmajorgrids, ymajorgrids, grid style={white!69.0196078431373!black},')
+    if figure.legend is not None:
+        loc, (x, y) = figure.legend
+        options.append('legend style={{fill opacity=0.8, draw opacity=1, text opacity=1, at={{({:g},{:g})}}, '
+                       'anchor={}, draw=white!80!black}},'.format(x, y, PGF_ANCHORS[loc]))
+        options.append('legend cell align={left},')
+    options.append('unbounded coords=discard,')
+    return options
+
+def pgf_line_options(line):
+    options = pgf_style(line['style'])
+    if line['steps']:
+        options.append('const plot')
+    if line['marker']:
+        options += ['mark={}'.format(PGF_MARKS.get(line['marker'], '*')),
+                    'mark size={:g}'.format(line['markersize'] / 2), 'mark options={solid}']
+        if not line['style'].get('linestyle', '-'):
+            options.append('only marks')
+    if line['label'] is None:
+        options.append('forget plot')
+    return options
+
+# pgfplots code and one table straight from the data of a util.figure.Figure, without matplotlib
+# colors are the TUMCOLOR names of the styles, lines are limited to the point budget like in get_tikz_code
+def save_pgfplot(figure, filepath, name='', encoding=None, axis_width='10cm', axis_height='5cm'):
+    if name:
+        name = name + '-'
+    filepath = '{}{}'.format(name or '', filepath)
+    tsv = filepath + '.tsv'
+    make_output_dirs()
+
+    columns = {}
+    libraries = set()
+    plots = []
+    files = []
+    for i, (image, extent, cmap) in enumerate(figure.images):
+        # log colored like imshow with LogNorm, empty cells are transparent
+        png = '{}-{:03d}.png'.format(filepath, i)
+        with replacing('data/' + png) as tmp_file:
+            imsave(tmp_file, cmap(LogNorm()(np.ma.masked_equal(image, 0))), origin='lower', format='png')
+        files.append('data/' + png)
+        plots.append(r'\addplot graphics [includegraphics cmd=\pgfimage, xmin={}, xmax={}, ymin={}, ymax={}] '
+                     r'{{data/{}}};'.format(*[pgf_number(value) for value in extent], png))
+    # bands below the lines
+    for i, (xs, lower, upper, style) in enumerate(figure.bands):
+        libraries.add('fillbetween')
+        columns.update({'bx{}'.format(i): xs, 'lower{}'.format(i): lower, 'upper{}'.format(i): upper})
+        for column in ['lower', 'upper']:
+            plots.append(r'\addplot [draw=none, forget plot, name path={0}{1}] '
+                         r'table [x=bx{1}, y={0}{1}] {{data/{2}}};'.format(column, i, tsv))
+        plots.append(r'\addplot [fill={}, fill opacity=0.3, forget plot] '
+                     r'fill between [of=upper{} and lower{}];'.format(style['color'], i, i))
+    limited = limit_lines([(line['xs'], line['ys']) for line in figure.lines], TIKZ_SETTINGS['max_points'])
+    for i, (line, (xs, ys)) in enumerate(zip(figure.lines, limited)):
+        if not len(xs):
+            continue
+        columns.update({'x{}'.format(i): xs, 'y{}'.format(i): ys})
+        plots.append(r'\addplot [{}] table [x=x{}, y=y{}] {{data/{}}};'.format(
+            ', '.join(pgf_line_options(line)), i, i, tsv))
+        if line['label'] is not None:
+            plots.append(r'\addlegendentry{{{}}}'.format(to_tex(line['label'])))
+    # prepared boxplots at 1, 2, ... with the fliers as data, empty histograms leave their position empty
+    for i, stats in enumerate(figure.boxes):
+        libraries.add('statistics')
+        if np.isnan(stats['med']):
+            continue
+        prepared = ', '.join('{}={}'.format(key, pgf_number(stats[stat])) for key, stat in [
+            ('median', 'med'), ('lower quartile', 'q1'), ('upper quartile', 'q3'),
+            ('lower whisker', 'whislo'), ('upper whisker', 'whishi')])
+        options = ('{edge}, solid, fill={face}, mark=o, mark options={{fill opacity=0}}, boxplot prepared='
+                   '{{draw position={}, {}, every median/.style={{{median}}}}}'.format(
+                       i + 1, prepared, **figure.box_style))
+        if not len(stats['fliers']):
+            plots.append(r'\addplot [{}] coordinates {{}};'.format(options))
+            continue
+        columns['fliers{}'.format(i)] = stats['fliers']
+        plots.append(r'\addplot [{}] table [y=fliers{}] {{data/{}}};'.format(options, i, tsv))
+    if columns:
+        write_table('data/' + tsv, columns, encoding)
+        files.append('data/' + tsv)
+
+    code = ([r'\begin{tikzpicture}', r'\begin{axis}['] + pgf_axis_options(figure, axis_width, axis_height) +
+            [']'] + plots + [r'\end{axis}', r'\end{tikzpicture}'])
+    filepath_end = 'figures/{}.tex'.format(filepath)
+    with replacing(filepath_end) as tmp_file, codecs.open(tmp_file, 'w', encoding) as fh:
+        fh.write('{}{}{}'.format(pgf_header(sorted(libraries)), '\n'.join(code), tikz_footer))
+    rprint('Generated ' + filepath_end)
+    return [filepath_end] + files
+
 
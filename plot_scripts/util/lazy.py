@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+
+
+import weakref
+from collections import OrderedDict
+import numpy as np
+rprint=print
+from pprint import pprint as print
+
+
+# In[ ]:
+
+
+# memoized views of all records share one memory budget, the least recently used views are released first
+VIEW_SETTINGS = {
+    'max_size': 512 * 1024 * 1024, # in bytes
+}
+VIEW_STATS = {
+    'computed': 0,
+    'released': 0,
+}
+# (record, view) -> size of all memoized views in order of their last access
+VIEW_CACHE = OrderedDict()
+
+def configure_views(max_size=None):
+    if max_size is not None:
+        VIEW_SETTINGS['max_size'] = max_size
+    enforce_view_budget()
+
+def print_view_stats():
+    rprint('Views: {computed} computed, {released} released, {size:.1f} MiB memoized'.format(
+        size=sum(VIEW_CACHE.values()) / 1024 / 1024, **VIEW_STATS))
+
+def view_size(value):
+    # bytes of the arrays held by a view, e.g. a Histogram or a plain array
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    return sum(item.nbytes for item in getattr(value, '__dict__', {}).values() if isinstance(item, np.ndarray))
+
+def enforce_view_budget(keep=None):
+    # views of records that no longer exist are gone already
+    for entry in [entry for entry in VIEW_CACHE if entry[0]() is None]:
+        del VIEW_CACHE[entry]
+    size = sum(VIEW_CACHE.values())
+    for entry in list(VIEW_CACHE):
+        if size <= VIEW_SETTINGS['max_size']:
+            break
+        if entry == keep:
+            continue
+        size -= VIEW_CACHE.pop(entry)
+        record = entry[0]()
+        if record is not None:
+            record.release(entry[1])
+
+
+# In[ ]:
+
+
+class LazyRecord:
+    # dict like record of one run, views are computed from the record on first access and memoized
+    # e.g. {'cdf': lambda run: run['hist'].cdf()}, released views are computed again when needed
+    def __init__(self, views, values=None):
+        self.views = views
+        self.values = dict(values or {})
+        self.memoized = {}
+        self.ref = weakref.ref(self)
+
+    def __getitem__(self, key):
+        if key in self.values:
+            return self.values[key]
+        if key in self.memoized:
+            VIEW_CACHE.move_to_end((self.ref, key))
+            return self.memoized[key]
+        if key not in self.views:
+            raise KeyError(key)
+        value = self.views[key](self)
+        self.memoized[key] = value
+        VIEW_CACHE[(self.ref, key)] = view_size(value)
+        VIEW_STATS['computed'] += 1
+        enforce_view_budget(keep=(self.ref, key))
+        return value
+
+    def __setitem__(self, key, value):
+        self.values[key] = value
+
+    def __contains__(self, key):
+        return key in self.values or key in self.views
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        return list(self.values) + [key for key in self.views if key not in self.values]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def release(self, *keys):
+        # drop memoized views, all of them if no keys are given
+        for key in keys or list(self.memoized):
+            if self.memoized.pop(key, None) is not None:
+                VIEW_CACHE.pop((self.ref, key), None)
+                VIEW_STATS['released'] += 1
+
+
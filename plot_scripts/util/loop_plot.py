@@ -4,9 +4,21 @@
 # In[ ]:
 
 
-import json
 import os
+import sys
+import math
+import numpy as np
 from glob import glob
+from util.cache import cached, map_files, encode_json, decode_json
+from util.bootstrap import DEFAULT_CONFIDENCE, aggregate_runs
+from util.i8_tikzplotlib import save_groupplot
+from util.figure import new_figure, finish, previews, figure_digest, cached_figure
+from util.tumcolor import tumcolor_cycler
+try:
+    # optional faster decoder, same results as json
+    from orjson import loads
+except ImportError:
+    from json import loads
 rprint=print
 from pprint import pprint as print
 
@@ -14,18 +26,36 @@ from pprint import pprint as print
 # In[ ]:
 
 
+# groups per row of faceted loop plots
+LOOP_FACET_COLUMNS = 3
+# line styles of the series of loop plots, the same series has the same style in every facet
+LOOP_STYLES = list(tumcolor_cycler)
+
+
+# In[ ]:
+
+
 def read_loopfile(loopfile):
-    data = None
-    with open(loopfile) as infile:
+    with open(loopfile, 'rb') as infile:
+        content = infile.read()
+    try:
+        return loads(content)
+    except ValueError:
+        # for old posd files, delete
+        return loads(content.replace(b"'", b'"'))
+
+def read_loopfiles(loopfiles):
+    # (run, loop variables) of all loop files of a folder, missing files are None
+    def read(loop):
         try:
-            data = json.load(infile)
-        except json.JSONDecodeError:
-            # for old posd files, delete
-            infile.seek(0)
-            content = infile.read()
-            content = content.replace("'", '"')
-            data = json.loads(content)
-    return data
+            return read_loopfile(loop)
+        except FileNotFoundError as exce:
+            rprint('Skipping {} - {}'.format(loop, exce), file=sys.stderr)
+            return None
+    return [[get_run(loop), data] for loop, data in zip(loopfiles, map_files(read, loopfiles)) if data is not None]
+
+def get_run(loopfile):
+    return int(loopfile.split('_run')[1].split('.loop')[0])
 
 
 # In[ ]:
@@ -50,17 +80,20 @@ def extract_loop_data(paths, loop_filename, basepath='/'):
         loopfile = os.path.join(extended_path, loop_filename)
         rprint('Processing loopfiles ' + loopfile)
         
-        loopfiles = glob(loopfile)
-        for loop in sorted(loopfiles):
-            rprint('Loopfile ' + loop)
-            run = int(loop.split('_run')[1].split('.loop')[0])
-                
-            # load data
-            try:
-                raw_data = read_loopfile(loop)
-            except FileNotFoundError as exce:
-                rprint('Skipping {} - {}'.format(loop, exce), file=sys.stderr)
-                continue
+        loopfiles = sorted(glob(loopfile))
+        if not loopfiles:
+            continue
+            
+        # load data, the loop variables of all runs are cached as one table next to the first loop file
+        # keyed on the names from the glob and the folder, without touching every loop file
+        try:
+            runs = cached(loopfiles, 'loops', lambda: read_loopfiles(loopfiles), encode_json, decode_json,
+                          folder=True)
+        except FileNotFoundError as exce:
+            rprint('Skipping {} - {}'.format(loopfile, exce), file=sys.stderr)
+            continue
+        rprint('{} loopfiles'.format(len(runs)))
+        for run, raw_data in runs:
             data[name][run] = raw_data
 
     return data
@@ -69,54 +102,194 @@ def extract_loop_data(paths, loop_filename, basepath='/'):
 # In[ ]:
 
 
-def _plot_loop(paths, name, tp_data, loop_file, loop_order, metrics, function, ape, **kwargs):
+class LoopTable:
+    # one row per run: experiment, run number, all loop variables and every computed metric
+    # loop variables are object columns (None if missing), metrics float columns (nan if missing)
+    def __init__(self, exps, runs, found, columns, variables):
+        self.exps = exps
+        self.runs = runs
+        self.found = found
+        self.columns = columns
+        self.variables = variables
+
+    def __len__(self):
+        return len(self.exps)
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def take(self, rows):
+        return LoopTable(self.exps[rows], self.runs[rows], self.found[rows],
+                         {name: column[rows] for name, column in self.columns.items()}, self.variables)
+
+    def groupby(self, keys):
+        # (values, table) of every combination of the keys present, a single sort over all keys
+        if not keys:
+            yield (), self
+            return
+        uniques, codes = zip(*[unique_values(self[key]) for key in keys])
+        codes = np.stack([code.reshape(-1) for code in codes], axis=1)
+        order = np.lexsort(codes.T[::-1])
+        codes = codes[order]
+        starts = np.flatnonzero(np.concatenate([[True], (codes[1:] != codes[:-1]).any(axis=1)]))
+        for start, end in zip(starts, np.append(starts[1:], len(order))):
+            yield tuple(unique[code] for unique, code in zip(uniques, codes[start])), self.take(order[start:end])
+
+def unique_values(column):
+    # sorted by value if comparable, e.g. packet sizes 64 < 128, otherwise as strings
+    try:
+        return np.unique(column, return_inverse=True)
+    except TypeError:
+        return np.unique(column.astype(str), return_inverse=True)
+
+def run_keys(data):
+    # (experiment, run number) -> key of the data, e.g. ('B', 3) -> 'B/histogram_run03.csv'
+    keys = {}
+    for key in data.keys():
+        exp, _, filename = key.rpartition('/')
+        number = filename.split('_run')[1].split('.')[0] if '_run' in filename else ''
+        if number.isdigit():
+            keys[(exp, int(number))] = key
+    return keys
+
+def build_loop_table(loop_data, data, columns):
+    # columns(record) returns the metrics of one run as {column: value}
+    keys = run_keys(data)
+    rows = []
+    for exp, l_data in loop_data.items():
+        for run, variables in l_data.items():
+            key = keys.get((exp, run))
+            rows.append((exp, run, key is not None, variables, columns(data[key]) if key is not None else {}))
+
+    variables = list(dict.fromkeys(name for row in rows for name in row[3]))
+    metrics = list(dict.fromkeys(name for row in rows for name in row[4]))
+    table = {}
+    for name in variables:
+        table[name] = np.empty(len(rows), dtype=object)
+        table[name][:] = [row[3].get(name) for row in rows]
+    for name in metrics:
+        table[name] = np.array([row[4].get(name, np.nan) for row in rows], dtype=np.float64)
+    exps = np.empty(len(rows), dtype=object)
+    exps[:] = [row[0] for row in rows]
+    return LoopTable(exps, np.array([row[1] for row in rows], dtype=np.int64),
+                     np.array([row[2] for row in rows], dtype=bool), table, variables)
+
+
+# In[ ]:
+
+
+def loop_axes(groups, figsize=(9,6)):
+    # one axis for a single group, otherwise a grid of facets sharing both axes, only for matplotlib exports
+    if groups == 1:
+        fig = new_figure(figsize)
+        return fig, [fig.subplots()]
+    columns = min(groups, LOOP_FACET_COLUMNS)
+    rows = int(math.ceil(groups / columns))
+    fig = new_figure((figsize[0] / 2 * columns, figsize[1] / 2 * rows))
+    axes = fig.subplots(rows, columns, sharex=True, sharey=True, squeeze=False)
+    for ax in axes.flat[groups:]:
+        fig.delaxes(ax)
+    return fig, list(axes.flat[:groups])
+
+def plot_loop_series(figure, table, x, series, confidence=DEFAULT_CONFIDENCE):
+    # series is a list of (label, experiment, metric column), repeated runs of the same loop point are
+    # aggregated for all series at once, the n-th series always has the n-th style of the cycler
+    # returns the drawn (label, xs, mean, lower, upper, style), lower and upper are None without repetitions
+    indices = []
+    xs = []
+    ys = []
+    for i, (_, exp, column) in enumerate(series):
+        rows = np.flatnonzero(table.found & (table.exps == exp) & ~np.isnan(table[column]))
+        indices.append(np.full(len(rows), i))
+        xs.append(table[x][rows])
+        ys.append(table[column][rows])
+    if not series or not sum(len(index) for index in indices):
+        return []
+    xs = np.array(np.concatenate(xs).tolist())
+    first, mean, lower, upper, counts = aggregate_runs(np.stack([np.concatenate(indices), xs], axis=1),
+                                                       np.concatenate(ys), confidence=confidence)
+    group_series = np.concatenate(indices)[first]
+    lines = []
+    for i, (label, _, _) in enumerate(series):
+        selected = group_series == i
+        if not selected.any():
+            continue
+        style = LOOP_STYLES[i % len(LOOP_STYLES)]
+        figure.line(xs[first[selected]], mean[selected], label=label, style=style, marker='x')
+        band = (None, None)
+        if counts[selected].max() > 1:
+            figure.band(xs[first[selected]], lower[selected], upper[selected], style)
+            band = (lower[selected], upper[selected])
+        lines.append((label, xs[first[selected]], mean[selected]) + band + (style,))
+    return lines
+
+def save_loop_plot(filepath, figures, facets, xlabel, ylabel, name='', exports=None):
+    # a single group as before, facets as one groupplot with the legend next to the last facet
+    for figure in figures:
+        figure.set_ylim(bottom=0)
+    if len(figures) == 1:
+        figures[0].xlabel = xlabel
+        figures[0].ylabel = ylabel
+        figures[0].legend = ('center left', (1, 0.5))
+        figures[0].save(filepath, name=name, exports=exports)
+        return
+    output = 'figures/{}.tex'.format('{}-{}'.format(name, filepath) if name else filepath)
+    digest = figure_digest(facets, filepath, xlabel, ylabel, name, LOOP_FACET_COLUMNS, exports, 'groupplot')
+    if (not cached_figure(output, digest, write_facets, filepath, figures, facets, xlabel, ylabel, name, exports)
+            and previews()):
+        finish(draw_facets(figures, facets, xlabel, ylabel), filepath, name)
+
+def write_facets(filepath, figures, facets, xlabel, ylabel, name='', exports=None):
+    # the groupplot and its additional exports from one matplotlib figure, returns the written files
+    files = save_groupplot(filepath, facets, xlabel=xlabel, ylabel=ylabel, name=name, columns=LOOP_FACET_COLUMNS)
+    if exports or previews():
+        files += finish(draw_facets(figures, facets, xlabel, ylabel), filepath, name, exports)
+    return files
+
+def draw_facets(figures, facets, xlabel, ylabel):
+    # the groupplot with matplotlib, for additional exports and previews
+    fig, axes = loop_axes(len(figures))
+    for ax, figure, (title, _) in zip(axes, figures, facets):
+        figure.title = title
+        if ax.get_subplotspec().is_last_row():
+            figure.xlabel = xlabel
+        if ax.get_subplotspec().is_first_col():
+            figure.ylabel = ylabel
+        figure.draw(ax)
+    handles = {}
+    for ax in axes:
+        handles.update(zip(*reversed(ax.get_legend_handles_labels())))
+    axes[-1].legend(list(handles.values()), list(handles.keys()), loc='center left', bbox_to_anchor=(1, 0.5))
+    return fig
+
+
+# In[ ]:
+
+
+def _plot_loop(paths, name, tp_data, loop_file, loop_order, metrics, function, ape, columns,
+               confidence=DEFAULT_CONFIDENCE, facets=False, **kwargs):
     print('---------------- plotting using loop variables ----------------------')
     loop_data = extract_loop_data(paths, loop_file, **kwargs)
-    
-    # group data by loop params
-    groups = {}
-    # first key
-    key = loop_order[0]
-    keys = [key]
-    for exp, l_data in loop_data.items():
-        for run, data in l_data.items():
-            value = str(data[key])
-            del data[key]
-            tup = (exp, run, data)
-            value = '{}-{}'.format(key, value)
-            try:
-                groups[value].append(tup)
-            except KeyError:
-                groups[value] = [tup]
-                
-    # if we have more keys sort the new subgroups
-    for key in loop_order[1:-1]:
-        new_groups = {}
-        for old_name, group in groups.items():
-            for item in group:
-                test, run, rest = item
-                current = rest[key]
-                del rest[key]
-                new_name = '{}-{}-{}'.format(old_name, key, current)
-                if new_name not in new_groups:
-                    new_groups[new_name] = []
-                new_groups[new_name].append((test, run, rest))
-        groups = new_groups
-                    
-    # names to {exp: {number: name}}
-    mapping = {}
-    for key in tp_data.keys():
-        exp = '/'.join(key.split('/')[:-1])
-        number = int(key.split('_run')[1].split('.')[0])
-        if exp not in mapping:
-            mapping[exp] = {}
-        mapping[exp][number] = key        
-
-    # plot groups
-    for key, content in groups.items():
-        plotname = key
+    table = build_loop_table(loop_data, tp_data, lambda record: columns(record, metrics))
+
+    # all but the last loop variable form the groups, the first other variable is the x axis
+    keys = loop_order[:-1] or loop_order[:1]
+    x = [variable for variable in table.variables if variable not in keys][0]
+    groups = [('-'.join('{}-{}'.format(key, value) for key, value in zip(keys, values)), content)
+              for values, content in table.groupby(keys)]
+
+    # plot groups, with facets all groups of a metric in one figure
+    if facets:
+        for metric in metrics:
+            function(name or '', groups, x, key=metric, additional_plot_exports=ape, confidence=confidence)
+        return
+    for plotname, content in groups:
         if name:
-            plotname = '{}_{}'.format(name, key)
+            plotname = '{}_{}'.format(name, plotname)
         for metric in metrics:
-            function(plotname, content, mapping, tp_data, key=metric, additional_plot_exports=ape)
+            function(plotname, content, x, key=metric, additional_plot_exports=ape, confidence=confidence)
+
 
@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+
+
+import os
+import re
+import math
+import numpy as np
+
+
+# In[ ]:
+
+
+MOONGEN_DATA_OUTPUT = ['mpps', 'mbit', 'mbitcrc']
+
+class ParsingError(Exception):
+    pass
+
+
+# In[ ]:
+
+
+# MoonGen prints the per second values of every device and direction, and a summary at the end
+# our logs contain colored output, e.g. '\x1b[0;34m[Device: id=0] TX\x1b[0m: 0.10 Mpps, ...'
+# [Packets counted] RX: 0.10 Mpps, 49 Mbit/s (65 Mbit/s with framing)
+# [Device: id=0] TX: 0.10 Mpps, 51 Mbit/s (67 Mbit/s with framing)
+# [Device: id=0] TX: 0.10 (StdDev 0.02) Mpps, 52 (StdDev 10) Mbit/s (68 Mbit/s with framing), total 3000000 packets ...
+MOONGEN_DEVICE = r'\[({}(?:Device: id=\d+|Packets counted)\] [RT]X)'
+MOONGEN_SAMPLE = r'\[{}\S*[ \t]+(\S+) Mpps, (\S+) Mbit/s \((\S+) Mbit/s with framing\)'
+MOONGEN_SUMMARY = re.compile(MOONGEN_DEVICE.format('') + r'\S*[ \t]+'
+                             r'(\S+) \(StdDev \S+\) Mpps, (\S+) \(StdDev \S+\) Mbit/s \((\S+) Mbit/s with framing\)'
+                             r'(?:, total (\d+) packets with (\d+) bytes)?')
+
+
+# In[ ]:
+
+
+# a run is a flat dict indexed by (device id, direction, metric)
+# per second values are numpy arrays, everything derived from them is a single float
+# metrics combining all devices, e.g. the packet loss, are stored for the pseudo device TOTAL
+TOTAL = ('total', 'tx-rx')
+
+def get_devices(run):
+    return sorted({(cid, direction) for cid, direction, _ in run},
+                  key=lambda device: (isinstance(device[0], str), device))
+
+def strip_values(values, strip):
+    return values[..., strip:-(strip+1)]
+
+
+# In[ ]:
+
+
+def find_moongen_devices(content):
+    # every search skips the devices we already know, a device is usually found within the first lines
+    devices = []
+    while True:
+        known = ''.join('(?!{})'.format(re.escape(device)) for device in devices)
+        match = re.search(MOONGEN_DEVICE.format(known), content)
+        if not match:
+            return devices
+        devices.append(match.group(1))
+
+def to_device(device):
+    # 'Device: id=0] TX' or 'Packets counted] RX'
+    name, direction = device.split('] ')
+    #TODO [Packets counted] is treated as device 0, does this make sense?
+    cid = 0
+    if not name == 'Packets counted':
+        cid = int(name.split('=')[-1])
+    return cid, direction.lower()
+
+def to_array(matches, columns):
+    return np.ascontiguousarray(np.array(matches, dtype=np.float64).reshape(-1, columns).T)
+
+
+# In[ ]:
+
+
+def find_summary(content, start=0):
+    # returns the start of the first and the last summary line
+    summary_start = content.find('(StdDev ', start)
+    summary_end = content.rfind('(StdDev ', start)
+    if summary_start < 0:
+        return len(content), len(content)
+    return content.rfind('\n', 0, summary_start) + 1, content.rfind('\n', 0, summary_end) + 1
+
+def add_summary(run, valid_file, content, start=0):
+    for device, mpps, mbit, mbitcrc, packets, size in MOONGEN_SUMMARY.findall(content, start):
+        cid, direction = to_device(device)
+        run[(cid, direction, 'avg_mg_mpps')] = float(mpps)
+        run[(cid, direction, 'avg_mg_mbit')] = float(mbit)
+        run[(cid, direction, 'avg_mg_mbitcrc')] = float(mbitcrc)
+        if packets:
+            run[(cid, direction, 'total_packets')] = int(packets)
+            run[(cid, direction, 'total_bytes')] = int(size)
+
+        valid_file[direction + '_summary'] = True
+
+
+# In[ ]:
+
+
+def add_samples(run, valid_file, content, end):
+    # appends the per second values printed before end, returns the number of new values
+    count = 0
+    for device in find_moongen_devices(content):
+        cid, direction = to_device(device)
+        pattern = re.compile(MOONGEN_SAMPLE.format(re.escape(device)))
+        samples = to_array(pattern.findall(content, 0, end), len(MOONGEN_DATA_OUTPUT))
+        for i, item in enumerate(MOONGEN_DATA_OUTPUT):
+            values = samples[i]
+            if (cid, direction, item) in run:
+                values = np.concatenate([run[(cid, direction, item)], values])
+            run[(cid, direction, item)] = values
+        if samples.shape[1]:
+            valid_file[direction] = True
+        count += samples.shape[1]
+    return count
+
+def parse_moongen_stdout(content, summary=True):
+    run = dict()
+    valid_file = dict()
+
+    # per second values are printed before the summary lines
+    summary_start, summary_end = find_summary(content)
+    add_samples(run, valid_file, content, summary_end)
+    add_summary(run, valid_file, content, summary_start)
+    # devices only listed in the summary
+    for cid, direction in get_devices(run):
+        for item in MOONGEN_DATA_OUTPUT:
+            run.setdefault((cid, direction, item), np.empty(0))
+
+    # the summary is missing while MoonGen is still running
+    required = ['rx', 'tx']
+    if summary:
+        required += ['rx_summary', 'tx_summary']
+    if not all(key in valid_file for key in required):
+        raise ParsingError('Invalid file: {}'.format(valid_file))
+    return run
+
+def read_moongen_stdout(exp):
+    with open(exp) as infile:
+        content = infile.read()
+    return parse_moongen_stdout(content)
+
+
+# In[ ]:
+
+
+# incremental parsing of a growing MoonGen stdout, e.g. while the experiment is still running
+# every call only parses the complete lines appended since the last call
+def new_follow_state():
+    return {'offset': 0, 'rest': b'', 'run': dict(), 'valid_file': dict()}
+
+def follow_moongen_stdout(exp, state):
+    with open(exp, 'rb') as infile:
+        size = infile.seek(0, os.SEEK_END)
+        if size < state['offset']:
+            # truncated or replaced by a new run
+            state.update(new_follow_state())
+        infile.seek(state['offset'])
+        chunk = state['rest'] + infile.read()
+        state['offset'] = infile.tell()
+
+    end = chunk.rfind(b'\n') + 1
+    state['rest'] = chunk[end:]
+    content = chunk[:end].decode(errors='replace')
+
+    # values might still be printed between the summary lines of the different devices
+    summary_start, summary_end = find_summary(content)
+    add_summary(state['run'], state['valid_file'], content, summary_start)
+    if not is_finished(state):
+        summary_end = len(content)
+    return add_samples(state['run'], state['valid_file'], content, summary_end)
+
+def is_finished(state):
+    return 'rx_summary' in state['valid_file'] and 'tx_summary' in state['valid_file']
+
+
+# In[ ]:
+
+
+# metrics that only need the summary lines at the end of the file
+SUMMARY_METRICS = ['avg_mg_mpps', 'avg_mg_mbit', 'avg_mg_mbitcrc',
+                   'total_packets', 'total_bytes', 'loss_packets', 'loss_ratio']
+SUMMARY_TAIL_SIZE = 4096
+
+def is_summary_only(metrics):
+    return bool(metrics) and all(metric in SUMMARY_METRICS for metric in metrics)
+
+def read_moongen_summary(exp, tail_size=SUMMARY_TAIL_SIZE):
+    run = dict()
+    valid_file = dict()
+    with open(exp, 'rb') as infile:
+        size = infile.seek(0, os.SEEK_END)
+        while True:
+            offset = max(0, size - tail_size)
+            infile.seek(offset)
+            content = infile.read().decode(errors='replace')
+            start = 0
+            if offset:
+                # the first line is most likely incomplete
+                start = content.find('\n') + 1
+            summary_start, _ = find_summary(content, start)
+            # read more if the summary might have started before the tail
+            if offset and (not start or summary_start == start or summary_start == len(content)):
+                tail_size *= 4
+                continue
+            break
+
+    add_summary(run, valid_file, content, summary_start)
+    if not len(valid_file.keys()) == 2:
+        raise ParsingError('Invalid file: {}'.format(valid_file))
+    return run
+
+
+# In[ ]:
+
+
+# MoonGen csv output, tx and rx are usually written to different files
+# Time,Direction,Id,PacketRate,Mbit,MbitWithFraming,TotalPackets,TotalBytes
+# 1602105032.58,TX,Device: id=0,0.098200,53.43,69.14,98200,6677600
+CSV_COLUMNS = {
+    'id'             : 'id',
+    'device'         : 'id',
+    'dir'            : 'direction',
+    'direction'      : 'direction',
+    'packetrate'     : 'mpps',
+    'mpps'           : 'mpps',
+    'mbit'           : 'mbit',
+    'mbitwithframing': 'mbitcrc',
+    'totalpackets'   : 'total_packets',
+    'totalbytes'     : 'total_bytes',
+}
+CSV_TOTALS = ['total_packets', 'total_bytes']
+# e.g. throughput_run000-tx.csv and throughput_run000-rx.csv are merged to throughput_run000.csv
+CSV_DIRECTION = re.compile(r'[-_.][rt]x(?=[-_.]|$)', re.IGNORECASE)
+
+def group_csv_files(files):
+    groups = dict()
+    for exp in files:
+        path, filename = os.path.split(exp)
+        merged = os.path.join(path, CSV_DIRECTION.sub('', filename, count=1))
+        if merged not in groups:
+            groups[merged] = []
+        groups[merged].append(exp)
+    return groups
+
+def read_moongen_csv(files):
+    run = dict()
+    valid_file = dict()
+    for exp in sorted(files):
+        with open(exp) as infile:
+            lines = infile.read().splitlines()
+        if not lines:
+            continue
+        header = [column.strip().lower() for column in lines[0].split(',')]
+        columns = {CSV_COLUMNS[column]: i for i, column in enumerate(header) if column in CSV_COLUMNS}
+        missing = [c for c in ['id', 'direction'] + MOONGEN_DATA_OUTPUT if c not in columns]
+        if missing:
+            raise ParsingError('Missing columns {} in {}'.format(missing, exp))
+        totals = [total for total in CSV_TOTALS if total in columns]
+        if len(lines) < 2:
+            continue
+
+        # one pass for the device columns, one for all numeric columns
+        keys = np.loadtxt(lines[1:], delimiter=',', dtype=str, ndmin=2,
+                          usecols=(columns['id'], columns['direction']))
+        values = np.loadtxt(lines[1:], delimiter=',', dtype=np.float64, ndmin=2,
+                            usecols=[columns[item] for item in MOONGEN_DATA_OUTPUT + totals])
+
+        devices, inverse = np.unique(keys, axis=0, return_inverse=True)
+        for i, (cid, direction) in enumerate(devices):
+            cid = int(re.sub(r'\D', '', cid) or 0)
+            direction = direction.strip().lower()
+            samples = np.ascontiguousarray(values[inverse.reshape(-1) == i].T)
+            for j, item in enumerate(MOONGEN_DATA_OUTPUT):
+                item_values = samples[j]
+                if (cid, direction, item) in run:
+                    item_values = np.concatenate([run[(cid, direction, item)], item_values])
+                run[(cid, direction, item)] = item_values
+            # totals are counted since the start, the last line contains the values for the whole run
+            for j, total in enumerate(totals, len(MOONGEN_DATA_OUTPUT)):
+                run[(cid, direction, total)] = int(samples[j][-1])
+            valid_file[direction] = True
+
+    if not ('rx' in valid_file and 'tx' in valid_file):
+        raise ParsingError('Invalid files: {}'.format(valid_file))
+    return run
+
+
+# In[ ]:
+
+
+# a run is in steady state while the spread of all values of a sliding window is within a
+# relative tolerance of the window mean, e.g. not during the warm-up of the load generator
+# steady state statistics are usable as soon as the confidence interval of the mean is narrow enough
+STEADY_STATE = {
+    'window'    : 5,    # seconds
+    'tolerance' : 0.02, # relative spread within a window
+    'confidence': 0.95, # confidence level of the interval of the mean
+    'precision' : 0.01, # relative half width of the confidence interval
+}
+
+# this module also runs on the load generator, see experiment/loadgen/steady_state.py
+# which has python 3.7 and numpy 1.16, i.e. no statistics.NormalDist or sliding_window_view
+def normal_quantile(p):
+    # inverse of the standard normal cdf by bisection of math.erf
+    low, high = -10.0, 10.0
+    for _ in range(64):
+        mid = (low + high) / 2
+        if (1 + math.erf(mid / math.sqrt(2))) / 2 < p:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
+
+def sliding_windows(values, window):
+    # read-only view of all windows along the last axis
+    shape = values.shape[:-1] + (values.shape[-1] - window + 1, window)
+    strides = values.strides + values.strides[-1:]
+    return np.lib.stride_tricks.as_strided(values, shape=shape, strides=strides, writeable=False)
+
+def find_steady_state(values, window=STEADY_STATE['window'], tolerance=STEADY_STATE['tolerance']):
+    # one row per item, the last second is incomplete
+    values = values[..., :-1]
+    if values.shape[-1] < window:
+        return None
+    windows = sliding_windows(values, window)
+    spread = windows.max(axis=-1) - windows.min(axis=-1)
+    steady = np.all(spread <= tolerance * np.abs(windows.mean(axis=-1)), axis=0)
+
+    # longest sequence of steady windows, e.g. not the zeros after the load generator stopped
+    edges = np.diff(np.concatenate([[0], steady.astype(np.int8), [0]]))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    if not len(starts):
+        return None
+    longest = np.argmax(ends - starts)
+    return int(starts[longest]), int(ends[longest]) + window - 1
+
+def find_convergence(values, confidence=STEADY_STATE['confidence'], precision=STEADY_STATE['precision'],
+                     min_samples=STEADY_STATE['window']):
+    # number of samples after which the confidence interval of the running mean is narrow enough
+    n = np.arange(1, values.shape[-1] + 1)
+    mean = np.cumsum(values, axis=-1) / n
+    var = np.maximum(np.cumsum(values ** 2, axis=-1) - n * mean ** 2, 0) / np.maximum(n - 1, 1)
+    half_width = normal_quantile((1 + confidence) / 2) * np.sqrt(var / n)
+    converged = np.flatnonzero(np.all(half_width <= precision * np.abs(mean), axis=0) & (n >= min_samples))
+    if not len(converged):
+        return None
+    return int(converged[0]) + 1
+
+def add_steady_state(run, window=STEADY_STATE['window'], tolerance=STEADY_STATE['tolerance'],
+                     confidence=STEADY_STATE['confidence'], precision=STEADY_STATE['precision']):
+    # all values in seconds since the start of the run, nan if never reached
+    converged = []
+    for cid, direction in get_devices(run):
+        if not (cid, direction, MOONGEN_DATA_OUTPUT[0]) in run:
+            continue
+        values = np.vstack([run[(cid, direction, item)] for item in MOONGEN_DATA_OUTPUT])
+
+        start, end, samples = np.nan, np.nan, None
+        bounds = find_steady_state(values, window, tolerance)
+        if bounds:
+            start, end = bounds
+            samples = find_convergence(values[:, start:end], confidence, precision, window)
+        run[(cid, direction, 'steady_start')] = float(start)
+        run[(cid, direction, 'steady_end')] = float(end)
+        run[(cid, direction, 'steady_converged')] = float(start + samples) if samples else np.nan
+        converged.append(run[(cid, direction, 'steady_converged')])
+
+    # the whole run converged as soon as the last device did
+    run[TOTAL + ('steady_converged',)] = float(np.max(converged)) if converged else np.nan
+    return run
+
+
+# In[ ]:
+
+
+DEFAULT_PERCENTILES = [1, 50, 99]
+
+def to_percentile_name(percentile):
+    return 'p{:g}'.format(percentile)
+
+def add_statistics(run, strip, percentiles=None):
+    if percentiles is None:
+        percentiles = DEFAULT_PERCENTILES
+
+    for cid, direction in get_devices(run):
+        if not (cid, direction, MOONGEN_DATA_OUTPUT[0]) in run:
+            continue
+        # one row per item, all statistics are calculated for all items at once
+        values = np.vstack([run[(cid, direction, item)] for item in MOONGEN_DATA_OUTPUT])
+        # the detected steady state replaces the fixed strip
+        start = run.get((cid, direction, 'steady_start'), np.nan)
+        if np.isnan(start):
+            values = strip_values(values, strip)
+        else:
+            values = values[..., int(start):int(run[(cid, direction, 'steady_end')])]
+
+        stats = dict()
+        if values.shape[1]:
+            stats['min'] = values.min(axis=1)
+            stats['max'] = values.max(axis=1)
+            stats['avg'] = values.mean(axis=1)
+            stats['std'] = values.std(axis=1)
+            if percentiles:
+                for percentile, row in zip(percentiles, np.percentile(values, percentiles, axis=1)):
+                    stats[to_percentile_name(percentile)] = row
+        else:
+            empty = np.full(len(MOONGEN_DATA_OUTPUT), np.nan)
+            for prefix in ['min', 'max', 'avg', 'std'] + [to_percentile_name(p) for p in percentiles]:
+                stats[prefix] = empty
+
+        for prefix, row in stats.items():
+            for item, value in zip(MOONGEN_DATA_OUTPUT, row):
+                run[(cid, direction, prefix + '_' + item)] = value
+
+    # packets sent but not received according to the totals of the summary
+    totals = {'tx': [], 'rx': []}
+    for cid, direction, metric in run:
+        if metric == 'total_packets' and direction in totals:
+            totals[direction].append(run[(cid, direction, metric)])
+    if totals['tx'] and totals['rx']:
+        sent = sum(totals['tx'])
+        loss = sent - sum(totals['rx'])
+        run[TOTAL + ('loss_packets',)] = loss
+        run[TOTAL + ('loss_ratio',)] = loss / sent if sent else np.nan
+    return run
+
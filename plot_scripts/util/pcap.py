@@ -0,0 +1,455 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+
+
+import os
+import re
+import sys
+import struct
+import numpy as np
+from util.histogram import Histogram
+from util.sequence import SEQUENCE_BUCKETS, SequenceReducer
+rprint=print
+from pprint import pprint as print
+
+
+# In[ ]:
+
+
+# captures are mapped and parsed in windows of this many bytes, TX and RX are matched one window at a time
+# so only the parsed timestamps and fields of about two windows of both captures are kept
+# reordered packets are matched as long as their TX and RX windows are at most one window apart
+PCAP_BLOCK_SIZE = 64 * 1024 * 1024
+# where the record length changes, e.g. mixed packet sizes, the records of this many bytes are followed at once
+PCAP_SPAN_SIZE = 1024 * 1024
+# pcap records within a span are assumed to be at most this many seconds apart to find them faster
+PCAP_TIMESTAMP_SLACK = 24 * 60 * 60
+# field of every packet (byte offset into the frame) used to match TX and RX, e.g. a sequence number in the
+# udp payload behind ethernet, ipv4 and udp headers
+# with timestamp the field is the TX timestamp in ns written by the sender, no TX capture is needed
+PCAP_FIELD = {
+    'offset'   : 42,
+    'size'     : 4,
+    'byteorder': 'big',
+    'timestamp': False,
+}
+PCAP_EXTENSIONS = ('.pcap', '.pcapng')
+# the TX capture is found by replacing the rx token of the file name, e.g. latency-rx.pcap -> latency-tx.pcap
+PCAP_DIRECTION = re.compile(r'(?<=[-_.])rx(?=[-_.])|^rx(?=[-_.])')
+PCAP_TX_DIRECTION = re.compile(r'(?<=[-_.])tx(?=[-_.])|^tx(?=[-_.])')
+
+# classic pcap magic -> (byte order, timestamp fraction in ns)
+PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1000),
+    b'\xa1\xb2\xc3\xd4': ('>', 1000),
+    b'\x4d\x3c\xb2\xa1': ('<', 1),
+    b'\xa1\xb2\x3c\x4d': ('>', 1),
+}
+PCAPNG_SECTION = b'\x0a\x0d\x0d\x0a'
+PCAPNG_SECTION_TYPE = 0x0a0d0d0a
+PCAPNG_INTERFACE = 1
+PCAPNG_PACKET = 6
+
+
+# In[ ]:
+
+
+def is_capture(exp):
+    return exp.endswith(PCAP_EXTENSIONS)
+
+def is_tx_capture(exp):
+    # read together with the RX capture, e.g. if both match a wildcard
+    return bool(PCAP_TX_DIRECTION.search(os.path.basename(exp)))
+
+def filter_captures(files, field=PCAP_FIELD):
+    if field['timestamp']:
+        return files
+    return [exp for exp in files if not (is_capture(exp) and is_tx_capture(exp))]
+
+def tx_capture(exp):
+    path, filename = os.path.split(exp)
+    if not PCAP_DIRECTION.search(filename):
+        return None
+    return os.path.join(path, PCAP_DIRECTION.sub('tx', filename))
+
+def capture_files(exp, field=PCAP_FIELD):
+    # all files the latencies depend on, missing TX captures are reported when reading
+    tx = tx_capture(exp)
+    if field['timestamp'] or tx is None:
+        return [exp]
+    return [exp, tx]
+
+def capture_kind(field=PCAP_FIELD):
+    # cache kind, the field changes the result
+    return 'pcap{}-{}{}{}'.format(field['offset'], field['size'], field['byteorder'][0],
+                                  't' if field['timestamp'] else '')
+
+
+# In[ ]:
+
+
+def gather(content, offsets, size, byteorder='little'):
+    # unsigned integers of size bytes at all offsets
+    columns = content[offsets[:, None] + np.arange(size)]
+    if size in (1, 2, 4, 8):
+        dtype = np.dtype('u{}'.format(size)).newbyteorder('<' if byteorder == 'little' else '>')
+        return np.ascontiguousarray(columns).view(dtype).ravel().astype(np.uint64)
+    columns = columns.astype(np.uint64)
+    if byteorder == 'little':
+        columns = columns[:, ::-1]
+    values = np.zeros(len(offsets), dtype=np.uint64)
+    for column in columns.T:
+        values = (values << np.uint64(8)) | column
+    return values
+
+def record_length(content, start, length, length_offset, length_extra):
+    stride = length.unpack_from(content, start + length_offset)[0] + length_extra
+    # a record contains at least its own length
+    if stride < length_offset + 4:
+        raise ValueError('corrupt record at byte {}'.format(start))
+    return stride
+
+def follow_records(content, start, end, length_offset, length_extra, plausible, unsigned):
+    # start of every record completely within [start, end) following the lengths from the record at start
+    # plausible(start, end) are the sorted offsets that could start a record, at least all records, e.g. of
+    # valid headers, the chain through them is found by pointer doubling in log(records) whole array steps
+    offsets = plausible(start, end)
+    offsets = np.concatenate([[start], offsets[offsets > start]]).astype(np.int64)
+    strides = gather(content, offsets + length_offset, 4, unsigned).astype(np.int64) + length_extra
+    nexts = offsets + strides
+    valid = strides >= length_offset + 4
+    index = np.searchsorted(offsets, nexts)
+    linked = valid & (index < len(offsets))
+    linked[linked] = offsets[index[linked]] == nexts[linked]
+
+    # jump to the record 2**k records ahead, the last index stands for the end of the chain
+    jump = np.append(np.where(linked, index, len(offsets)), len(offsets))
+    reached = np.zeros(len(jump), dtype=bool)
+    reached[[0, -1]] = True
+    while True:
+        ahead = jump[reached]
+        if reached[ahead].all():
+            break
+        reached[ahead] = True
+        jump = jump[jump]
+    chain = np.flatnonzero(reached[:-1])
+
+    # the chain ends at a corrupt record, one beyond end or before a record that was not plausible
+    chain = chain[(nexts[chain] <= end) & valid[chain]]
+    if not len(chain):
+        return np.zeros(0, dtype=np.int64), start
+    return offsets[chain], int(nexts[chain[-1]])
+
+def record_offsets(content, start, end, endian, length_offset, length_extra, plausible=None):
+    # start of every record completely within [start, end), records are (length at length_offset + length_extra)
+    # bytes long, packets of a capture have mostly the same length so the records are first assumed to be
+    # equidistant and checked at once, where the length changes the records of the next span are followed
+    # through the plausible offsets at once, or walked one by one without
+    # the number of checked records doubles while the length stays the same
+    length = struct.Struct(endian + 'I')
+    unsigned = 'little' if endian == '<' else 'big'
+    buffer = memoryview(content)
+    found = []
+    limit = 64
+    while start + length_offset + 4 <= end:
+        stride = record_length(content, start, length, length_offset, length_extra)
+        count = min((end - start) // stride, limit)
+        if not count:
+            break
+        candidates = start + np.arange(count, dtype=np.int64) * stride
+        lengths = gather(content, candidates + length_offset, 4, unsigned)
+        changed = np.flatnonzero(lengths + length_extra != stride)
+        limit = 64 if len(changed) else 2 * limit
+        count = changed[0] if len(changed) else count
+        found.append(candidates[:count])
+        start += count * stride
+        if not len(changed):
+            continue
+        walked = np.zeros(0, dtype=np.int64)
+        if plausible is not None:
+            walked, start = follow_records(content, start, min(end, start + PCAP_SPAN_SIZE), length_offset,
+                                           length_extra, plausible, unsigned)
+        # walk the next records one by one if none could be followed, e.g. after a record that was not plausible
+        if not len(walked):
+            walked = []
+            while len(walked) < 64 and start + length_offset + 4 <= end:
+                stride = record_length(buffer, start, length, length_offset, length_extra)
+                if start + stride > end:
+                    break
+                walked.append(start)
+                start += stride
+        found.append(np.asarray(walked, dtype=np.int64))
+    return np.concatenate(found) if found else np.zeros(0, dtype=np.int64), start
+
+def read_blocks(content, start, endian, length_offset, length_extra, block_size, plausible=None):
+    # record offsets of one window at a time
+    size = len(content)
+    while start < size:
+        window = min(size, start + block_size)
+        offsets, end = record_offsets(content, start, window, endian, length_offset, length_extra, plausible)
+        if not len(offsets):
+            stride = record_length(content, start, struct.Struct(endian + 'I'), length_offset, length_extra) \
+                if start + length_offset + 4 <= size else size
+            if start + stride > size:
+                rprint('Ignoring truncated record at byte {}'.format(start), file=sys.stderr)
+                return
+            # a single record larger than the window
+            offsets, end = np.array([start], dtype=np.int64), start + stride
+        yield offsets
+        start = end
+
+
+# In[ ]:
+
+
+def pcap_headers(content, endian, fraction):
+    # offsets of 16 byte record headers with a valid fraction of a second, a captured length between zero and
+    # the original one and seconds close to the record at start, read as 4 byte words at every alignment
+    dtype = np.dtype(endian + 'u4')
+    limit = 1000000000 // fraction
+    def plausible(start, end):
+        first = int(np.frombuffer(content, dtype, 1, start)[0])
+        low, high = max(0, first - PCAP_TIMESTAMP_SLACK), first + PCAP_TIMESTAMP_SLACK
+        offsets = []
+        for alignment in range(4):
+            count = (end - start - alignment) // 4
+            if count < 4:
+                continue
+            words = np.frombuffer(content, dtype, count, start + alignment)
+            seconds, fractions, captured, original = words[:-3], words[1:-2], words[2:-1], words[3:]
+            valid = ((fractions < limit) & (captured > 0) & (captured <= original)
+                     & (seconds >= low) & (seconds <= high))
+            offsets.append(start + alignment + 4 * np.flatnonzero(valid))
+        return np.sort(np.concatenate(offsets)) if offsets else np.zeros(0, dtype=np.int64)
+    return plausible
+
+def read_pcap(content, field, block_size):
+    # timestamps, fields and record offsets of the packets of one window at a time
+    endian, fraction = PCAP_MAGIC[bytes(content[:4])]
+    unsigned = 'little' if endian == '<' else 'big'
+    end = field['offset'] + field['size']
+    # 24 byte file header, 16 byte record header: seconds, fraction, captured length, original length
+    for offsets in read_blocks(content, 24, endian, 8, 16, block_size, pcap_headers(content, endian, fraction)):
+        offsets = offsets[gather(content, offsets + 8, 4, unsigned) >= end]
+        seconds = gather(content, offsets, 4, unsigned).astype(np.int64)
+        fractions = gather(content, offsets + 4, 4, unsigned).astype(np.int64)
+        yield (seconds * 1000000000 + fractions * fraction,
+               gather(content, offsets + 16 + field['offset'], field['size'], field['byteorder']), offsets)
+
+def interface_resolution(block, endian):
+    # if_tsresol option of an interface description block as ticks per second, microseconds by default
+    position = 16
+    while position + 4 <= len(block) - 4:
+        code, length = struct.unpack_from(endian + 'HH', block, position)
+        if code == 0:
+            break
+        if code == 9 and length == 1:
+            value = block[position + 4]
+            return 2 ** (value & 0x7f) if value & 0x80 else 10 ** value
+        position += 4 + (length + 3) // 4 * 4
+    return 1000000
+
+def to_ns(ticks, resolution):
+    # split into seconds and the fraction of a second, ticks * 10**9 would overflow
+    seconds = ticks // resolution
+    fractions = ticks % resolution
+    if resolution <= 2 ** 33:
+        fractions = fractions * 1000000000 // resolution
+    else:
+        fractions = fractions // (resolution // 1000000000)
+    return seconds * 1000000000 + fractions
+
+def pcapng_blocks(content, endian):
+    # offsets of blocks with a total length of at least 12 bytes and a multiple of 4 at their start and end,
+    # blocks are 4 byte aligned
+    dtype = np.dtype(endian + 'u4')
+    def plausible(start, end):
+        words = np.frombuffer(content, dtype, (end - start) // 4, start)
+        lengths = words[1:].astype(np.int64)
+        valid = (lengths % 4 == 0) & (lengths >= 12)
+        # the trailing length of blocks that end after end is not checked
+        last = np.arange(len(lengths)) + lengths // 4 - 1
+        inside = valid & (last < len(words))
+        valid[inside] = words[last[inside]] == lengths[inside]
+        return start + 4 * np.flatnonzero(valid)
+    return plausible
+
+def read_pcapng(content, field, block_size):
+    # timestamps, fields and block offsets of the packets of one window at a time
+    endian = '<' if bytes(content[8:12]) == b'\x4d\x3c\x2b\x1a' else '>'
+    unsigned = 'little' if endian == '<' else 'big'
+    end = field['offset'] + field['size']
+    interfaces = []
+    sections = 0
+    # every block: type, total length, body, total length
+    for offsets in read_blocks(content, 0, endian, 4, 0, block_size, pcapng_blocks(content, endian)):
+        types = gather(content, offsets, 4, unsigned)
+        sections += np.count_nonzero(types == PCAPNG_SECTION_TYPE)
+        if sections > 1:
+            raise ValueError('captures with multiple sections are not supported')
+        for offset in offsets[types == PCAPNG_INTERFACE]:
+            length = struct.unpack_from(endian + 'I', content, offset + 4)[0]
+            interfaces.append(interface_resolution(bytes(content[offset:offset + length]), endian))
+        # enhanced packet blocks: interface, timestamp high and low, captured length, original length, data
+        offsets = offsets[types == PCAPNG_PACKET]
+        offsets = offsets[gather(content, offsets + 20, 4, unsigned) >= end]
+        interface = gather(content, offsets + 8, 4, unsigned).astype(np.int64)
+        ticks = (gather(content, offsets + 12, 4, unsigned) << np.uint64(32)) | gather(content, offsets + 16, 4,
+                                                                                          unsigned)
+        if len(interface) and interface.max() >= len(interfaces):
+            raise ValueError('packet of undescribed interface {}'.format(interface.max()))
+        stamps = np.zeros(len(offsets), dtype=np.int64)
+        for number, resolution in enumerate(interfaces):
+            selected = interface == number
+            stamps[selected] = to_ns(ticks[selected].astype(np.int64), resolution)
+        yield stamps, gather(content, offsets + 28 + field['offset'], field['size'], field['byteorder']), offsets
+
+def capture_blocks(exp, field=PCAP_FIELD, block_size=PCAP_BLOCK_SIZE):
+    # timestamp (ns), field and byte offset of every packet in capture order, one window at a time
+    if not os.path.getsize(exp):
+        return
+    content = np.memmap(exp, dtype=np.uint8, mode='r')
+    magic = bytes(content[:4])
+    if magic in PCAP_MAGIC:
+        yield from read_pcap(content, field, block_size)
+    elif magic == PCAPNG_SECTION:
+        yield from read_pcapng(content, field, block_size)
+    else:
+        raise ValueError('unknown capture format of {}'.format(exp))
+
+def read_capture(exp, field=PCAP_FIELD, block_size=PCAP_BLOCK_SIZE):
+    # timestamp (ns) and field of every packet in capture order
+    blocks = [block[:2] for block in capture_blocks(exp, field, block_size)]
+    if not blocks:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint64)
+    timestamps, fields = zip(*blocks)
+    return np.concatenate(timestamps), np.concatenate(fields)
+
+
+# In[ ]:
+
+
+def unwrap(fields, size, state=None):
+    # sequence numbers of less than 8 bytes wrap around, a drop by more than half the range is a wrap
+    # state carries the last number and the wraps from one window to the next, see new_unwrap_state
+    if size >= 8 or not len(fields):
+        return fields.astype(np.int64)
+    fields = fields.astype(np.int64)
+    period = 1 << (8 * size)
+    previous = fields[:1] if state is None or state['last'] is None else [state['last']]
+    wraps = np.cumsum(np.diff(np.concatenate([previous, fields])) < -(period // 2))
+    if state is not None:
+        wraps += state['wraps']
+        state['last'] = fields[-1]
+        state['wraps'] = wraps[-1]
+    return fields + wraps * period
+
+def new_unwrap_state():
+    return {'last': None, 'wraps': 0}
+
+def first_occurences(ids, *columns):
+    # sorted unique ids, duplicates, e.g. retransmissions or mirrored twice, count with their first appearance
+    if (np.diff(ids) > 0).all():
+        return (ids,) + columns
+    ids, first = np.unique(ids, return_index=True)
+    return (ids,) + tuple(column[first] for column in columns)
+
+def merge_pending(pending, ids, *columns):
+    # packets of a new window added to the unmatched ones of earlier windows, which come first
+    return first_occurences(*[np.concatenate([old, new]) for old, new in zip(pending, (ids,) + columns)])
+
+def match_windows(rx, tx=None, field=PCAP_FIELD, block_size=PCAP_BLOCK_SIZE):
+    # (sequence numbers, latencies in ns, byte offsets of the RX records) of the packets matched per window
+    # the capture that is behind, by the median id of its last window, is read next, unmatched packets are kept
+    # until both captures are a window ahead of them, i.e. only a few windows of both captures are in memory
+    stats = {'sent': 0, 'received': 0, 'matched': 0, 'negative': 0}
+    if field['timestamp']:
+        for timestamps, fields, offsets in capture_blocks(rx, field, block_size):
+            numbers = stats['received'] + np.arange(len(fields), dtype=np.int64)
+            stats['received'] += len(fields)
+            latencies = timestamps - fields.astype(np.int64)
+            negative = latencies < 0
+            stats['negative'] += np.count_nonzero(negative)
+            yield numbers[~negative], latencies[~negative], offsets[~negative]
+        rprint('{} packets received'.format(stats['received']))
+    else:
+        if tx is None:
+            raise FileNotFoundError('no TX capture for {}'.format(rx))
+        empty = np.zeros(0, dtype=np.int64)
+        blocks = {'tx': capture_blocks(tx, field, block_size), 'rx': capture_blocks(rx, field, block_size)}
+        states = {'tx': new_unwrap_state(), 'rx': new_unwrap_state()}
+        # ids and timestamps of TX, ids, timestamps and offsets of RX
+        pending = {'tx': (empty, empty), 'rx': (empty, empty, empty)}
+        ahead = {'tx': -np.inf, 'rx': -np.inf}
+        behind = {'tx': -np.inf, 'rx': -np.inf}
+        counter = {'tx': 'sent', 'rx': 'received'}
+        while blocks['tx'] is not None or blocks['rx'] is not None:
+            side = 'rx' if ahead['rx'] <= ahead['tx'] else 'tx'
+            if blocks[side] is None:
+                side = 'tx' if side == 'rx' else 'rx'
+            block = next(blocks[side], None)
+            if block is None:
+                blocks[side] = None
+                ahead[side] = behind[side] = np.inf
+                continue
+            timestamps, fields, offsets = block
+            stats[counter[side]] += len(fields)
+            ids = unwrap(fields, field['size'], states[side])
+            pending[side] = merge_pending(pending[side], ids, timestamps, *([offsets] if side == 'rx' else []))
+            if len(ids):
+                # the median is robust against other traffic in the captures
+                behind[side], ahead[side] = ahead[side], np.median(ids)
+
+            # sort based join of the sorted unique ids, matched packets are done
+            numbers, tx_index, rx_index = np.intersect1d(pending['tx'][0], pending['rx'][0], assume_unique=True,
+                                                         return_indices=True)
+            latencies = pending['rx'][1][rx_index] - pending['tx'][1][tx_index]
+            offsets = pending['rx'][2][rx_index]
+            evict = min(behind.values())
+            for name, index in [('tx', tx_index), ('rx', rx_index)]:
+                keep = pending[name][0] >= evict
+                keep[index] = False
+                pending[name] = tuple(column[keep] for column in pending[name])
+            negative = latencies < 0
+            stats['negative'] += np.count_nonzero(negative)
+            stats['matched'] += len(numbers) - np.count_nonzero(negative)
+            yield numbers[~negative], latencies[~negative], offsets[~negative]
+        rprint('{sent} packets sent, {received} received, {matched} matched'.format(**stats))
+    if stats['negative']:
+        rprint('Dropping {} packets received before they were sent'.format(stats['negative']), file=sys.stderr)
+
+def match_captures(rx, tx=None, field=PCAP_FIELD, block_size=PCAP_BLOCK_SIZE):
+    # (sequence numbers, latencies in ns) of all packets received
+    windows = [window[:2] for window in match_windows(rx, tx, field, block_size)]
+    if not windows:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    numbers, latencies = zip(*windows)
+    return np.concatenate(numbers), np.concatenate(latencies)
+
+def merge_histograms(hists):
+    return Histogram.from_pairs(np.concatenate([hist.values for hist in hists]),
+                                np.concatenate([hist.counts for hist in hists]))
+
+def read_capture_histogram(exp, field=PCAP_FIELD, block_size=PCAP_BLOCK_SIZE):
+    # histograms of the windows are added as soon as they have more values than the sum so far
+    hist = Histogram(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    windows = []
+    for _, latencies, _ in match_windows(*capture_files(exp, field)[:2], field=field, block_size=block_size):
+        windows.append(Histogram.from_pairs(latencies, np.ones(len(latencies), dtype=np.int64)))
+        if sum(len(window) for window in windows) >= len(hist):
+            hist = merge_histograms([hist] + windows)
+            windows = []
+    return merge_histograms([hist] + windows)
+
+def read_capture_sequence(exp, field=PCAP_FIELD, buckets=SEQUENCE_BUCKETS, block_size=PCAP_BLOCK_SIZE):
+    # bucketed by the byte offset of the RX records like read_sequence by the offset of the lines
+    size = os.path.getsize(exp)
+    reducer = SequenceReducer(buckets)
+    for numbers, latencies, offsets in match_windows(*capture_files(exp, field)[:2], field=field,
+                                                     block_size=block_size):
+        reducer.add(offsets * buckets // size, numbers, latencies)
+    return reducer.result()
+
+
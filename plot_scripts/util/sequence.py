@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+
+
+import os
+import numpy as np
+from util.histogram import HDR_SIGNIFICANT_DIGITS, LogHistogram
+
+
+# In[ ]:
+
+
+# sequence files are streamed in blocks of this many bytes, peak memory does not depend on the file size
+SEQUENCE_BLOCK_SIZE = 64 * 1024 * 1024
+# the file is split into this many buckets by byte offset, each keeps its minimum and maximum latency
+SEQUENCE_BUCKETS = 2000
+# latency rows of the density grid, 2 digits are at most 1% error
+DENSITY_SIGNIFICANT_DIGITS = 2
+# maximum number of rows of the rendered density image
+DENSITY_ROWS = 200
+
+
+# In[ ]:
+
+
+class Sequence:
+    # decimated (sequence number, latency) series, at most the minimum and maximum of every bucket
+    # the quantile sketch, minimum, maximum and count cover all packets
+    def __init__(self, numbers, latencies, sketch, minimum, maximum, count, unit=1, density=None):
+        self.numbers = numbers
+        self.latencies = latencies
+        self.sketch = sketch
+        self.minimum = minimum
+        self.maximum = maximum
+        self.count = count
+        self.unit = unit
+        self.density = density
+
+    @classmethod
+    def from_dict(cls, data, unit=1):
+        numbers = np.fromiter(data.keys(), dtype=np.float64, count=len(data))
+        latencies = np.fromiter(data.values(), dtype=np.float64, count=len(data))
+        order = np.argsort(numbers, kind='stable')
+        return cls(numbers[order], latencies[order], None, latencies.min(initial=np.inf),
+                   latencies.max(initial=-np.inf), len(data), unit)
+
+    def __len__(self):
+        return len(self.numbers)
+
+    @property
+    def xs(self):
+        return self.numbers
+
+    @property
+    def ys(self):
+        # latencies in the plotted unit
+        if self.unit == 1:
+            return self.latencies
+        return self.latencies / self.unit
+
+    def to_unit(self, unit):
+        sketch = self.sketch.to_unit(unit) if self.sketch is not None else None
+        density = self.density.to_unit(unit) if self.density is not None else None
+        return Sequence(self.numbers, self.latencies, sketch, self.minimum, self.maximum, self.count, unit, density)
+
+    def percentile(self, q):
+        # from the sketch, relative error bounded by its significant digits
+        if self.sketch is None:
+            return np.percentile(self.ys, q)
+        return self.sketch.percentile(q)
+
+
+# In[ ]:
+
+
+class SequenceDensity:
+    # packets per latency row (log buckets starting at offset) and column (bucket of the file)
+    # minimum and maximum are the exact latencies per column, first and last the range of sequence numbers
+    def __init__(self, counts, offset, minimum, maximum, first, last,
+                 significant_digits=DENSITY_SIGNIFICANT_DIGITS, unit=1):
+        self.counts = counts
+        self.offset = offset
+        self.minimum = minimum
+        self.maximum = maximum
+        self.first = first
+        self.last = last
+        self.significant_digits = significant_digits
+        self.unit = unit
+
+    @property
+    def xs(self):
+        # sequence numbers of the column centers, the columns split the file evenly
+        columns = self.counts.shape[1]
+        return self.first + (np.arange(columns) + 0.5) * (self.last - self.first) / columns
+
+    def to_unit(self, unit):
+        return SequenceDensity(self.counts, self.offset, self.minimum, self.maximum, self.first, self.last,
+                               self.significant_digits, unit)
+
+    def row_bounds(self):
+        rows = LogHistogram(None, self.significant_digits)
+        return rows.bucket_bounds(self.offset + np.arange(len(self.counts)))
+
+    def envelope(self):
+        # minimum, median and maximum latency of every used column
+        totals = self.counts.sum(axis=0)
+        used = totals > 0
+        lowest, highest = self.row_bounds()
+        below = np.cumsum(self.counts[:, used], axis=0)
+        median = np.argmax(2 * below >= totals[used], axis=0)
+        middle = lowest + (highest - lowest + 1) // 2
+        return (self.xs[used], self.minimum[used] / self.unit, middle[median] / self.unit,
+                self.maximum[used] / self.unit)
+
+    def image(self, rows=DENSITY_ROWS):
+        # latency rows resampled to a linear axis, a row is never finer than the widest log bucket
+        used = self.counts.sum(axis=0) > 0
+        low = self.minimum[used].min()
+        high = self.maximum[used].max() + 1
+        lowest, highest = self.row_bounds()
+        rows = int(max(1, min(rows, (high - low) // (highest - lowest + 1).max())))
+        middle = lowest + (highest - lowest + 1) // 2
+        target = np.clip((middle - low) * rows // (high - low), 0, rows - 1)
+        image = np.zeros((rows, self.counts.shape[1]), dtype=np.int64)
+        np.add.at(image, target, self.counts)
+        return image, [self.first, self.last, low / self.unit, high / self.unit]
+
+
+# In[ ]:
+
+
+def add_density(counts, offset, columns, latencies, significant_digits=DENSITY_SIGNIFICANT_DIGITS):
+    # rows are only allocated between the lowest and highest latency seen so far
+    rows = LogHistogram(None, significant_digits).bucket_index(latencies)
+    if not len(counts):
+        offset = rows.min()
+    low = min(offset, rows.min())
+    high = max(offset + len(counts), rows.max() + 1)
+    if len(counts) < high - low:
+        counts = np.pad(counts, ((offset - low, high - offset - len(counts)), (0, 0)))
+        offset = low
+    cells = (rows - offset) * counts.shape[1] + columns
+    counts += np.bincount(cells, minlength=counts.size).reshape(counts.shape)
+    return counts, offset
+
+def reduce_buckets(buckets, numbers, latencies):
+    # minimum and maximum latency (with their sequence number) of every bucket present in the block
+    order = np.lexsort((latencies, buckets))
+    buckets = buckets[order]
+    starts = np.flatnonzero(np.concatenate([[True], buckets[1:] != buckets[:-1]]))
+    ends = np.append(starts[1:], len(buckets)) - 1
+    return (buckets[starts], numbers[order][starts], latencies[order][starts],
+            numbers[order][ends], latencies[order][ends])
+
+def line_offsets(block, lines):
+    # start of every non empty line, evenly spread if the lines do not match the parsed rows
+    ends = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n'))
+    if not block.endswith(b'\n'):
+        ends = np.append(ends, len(block))
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    starts = starts[ends > starts]
+    if not len(starts) == lines:
+        return np.arange(lines) * len(block) // lines
+    return starts
+
+class SequenceReducer:
+    # running state of a decimated sequence, packets are added in blocks assigned to one of the buckets
+    def __init__(self, buckets=SEQUENCE_BUCKETS, significant_digits=HDR_SIGNIFICANT_DIGITS):
+        self.min_numbers = np.zeros(buckets, dtype=np.int64)
+        self.min_latencies = np.full(buckets, np.iinfo(np.int64).max)
+        self.max_numbers = np.zeros(buckets, dtype=np.int64)
+        self.max_latencies = np.full(buckets, np.iinfo(np.int64).min)
+        self.sketch = LogHistogram(np.zeros(0, dtype=np.int64), significant_digits)
+        self.density = np.zeros((0, buckets), dtype=np.int64)
+        self.offset = 0
+        self.first = np.iinfo(np.int64).max
+        self.last = np.iinfo(np.int64).min
+        self.count = 0
+
+    def add(self, columns, numbers, latencies):
+        if not len(numbers):
+            return
+        found, lo_numbers, lo_latencies, hi_numbers, hi_latencies = reduce_buckets(columns, numbers, latencies)
+        lower = lo_latencies < self.min_latencies[found]
+        self.min_numbers[found[lower]] = lo_numbers[lower]
+        self.min_latencies[found[lower]] = lo_latencies[lower]
+        higher = hi_latencies > self.max_latencies[found]
+        self.max_numbers[found[higher]] = hi_numbers[higher]
+        self.max_latencies[found[higher]] = hi_latencies[higher]
+        self.sketch = self.sketch.merge(LogHistogram.from_values(latencies, self.sketch.significant_digits))
+        self.density, self.offset = add_density(self.density, self.offset, columns, latencies)
+        self.first = min(self.first, numbers.min())
+        self.last = max(self.last, numbers.max())
+        self.count += len(numbers)
+
+    def result(self):
+        # minimum and maximum of every used bucket in the order of the sequence numbers, single packets only once
+        used = self.min_latencies <= self.max_latencies
+        numbers = np.stack([self.min_numbers[used], self.max_numbers[used]], axis=1)
+        latencies = np.stack([self.min_latencies[used], self.max_latencies[used]], axis=1)
+        keep = np.ones(numbers.shape, dtype=bool)
+        keep[:, 1] = numbers[:, 0] != numbers[:, 1]
+        numbers = numbers[keep]
+        latencies = latencies[keep]
+        order = np.argsort(numbers, kind='stable')
+        if not self.count:
+            return Sequence(numbers, latencies, self.sketch, 0, 0, self.count)
+        density = SequenceDensity(self.density, self.offset, self.min_latencies, self.max_latencies,
+                                  self.first, self.last)
+        return Sequence(numbers[order], latencies[order], self.sketch, self.min_latencies[used].min(),
+                        self.max_latencies[used].max(), self.count, density=density)
+
+
+def read_sequence(exp, buckets=SEQUENCE_BUCKETS, block_size=SEQUENCE_BLOCK_SIZE,
+                  significant_digits=HDR_SIGNIFICANT_DIGITS):
+    # two columns: sequence number, latency
+    size = os.path.getsize(exp)
+    reducer = SequenceReducer(buckets, significant_digits)
+
+    # the memory map is never read as a whole, only one block and its parsed values at a time
+    content = np.memmap(exp, dtype=np.uint8, mode='r') if size else np.zeros(0, dtype=np.uint8)
+    start = 0
+    while start < size:
+        block = content[start:start + block_size].tobytes()
+        if start + len(block) < size:
+            # the partial last line belongs to the next block
+            cut = block.rfind(b'\n') + 1
+            if not cut:
+                raise ValueError('line longer than the block size in {}'.format(exp))
+            block = block[:cut]
+        data = np.fromstring(block.decode().replace(',', ' '), dtype=np.int64, sep=' ').reshape(-1, 2)
+        if len(data):
+            # bucket by the byte offset of the lines, the number of lines is not known upfront
+            columns = (start + line_offsets(block, len(data))) * buckets // size
+            reducer.add(columns, data[:, 0], data[:, 1])
+        start += len(block)
+    return reducer.result()
+
+def to_sequence(data):
+    # plot functions also accept the old {sequence number: latency} dicts
+    if isinstance(data, Sequence):
+        return data
+    return Sequence.from_dict(data)
+
+def encode_sequence(seq):
+    columns = {'numbers': seq.numbers, 'latencies': seq.latencies, 'sketch': seq.sketch.counts,
+               'significant_digits': np.asarray(seq.sketch.significant_digits),
+               'stats': np.array([seq.minimum, seq.maximum, seq.count, seq.unit], dtype=np.int64)}
+    if seq.density is not None:
+        density = seq.density
+        columns.update({'density': density.counts, 'density_minimum': density.minimum,
+                        'density_maximum': density.maximum,
+                        'density_stats': np.array([density.offset, density.first, density.last,
+                                                   density.significant_digits], dtype=np.int64)})
+    return columns
+
+def decode_sequence(columns):
+    minimum, maximum, count, unit = columns['stats'].tolist()
+    sketch = LogHistogram(columns['sketch'], columns['significant_digits'].item(), unit)
+    density = None
+    if 'density' in columns:
+        offset, first, last, significant_digits = columns['density_stats'].tolist()
+        density = SequenceDensity(columns['density'], offset, columns['density_minimum'],
+                                  columns['density_maximum'], first, last, significant_digits, unit)
+    return Sequence(columns['numbers'], columns['latencies'], sketch, minimum, maximum, count, unit, density)
+
+
@@ -4,7 +4,7 @@
 # In[ ]:
 
 
-from matplotlib.colors import _colors_full_map, ListedColormap
+from matplotlib.colors import _colors_full_map, ListedColormap, LinearSegmentedColormap
 from matplotlib.cm import register_cmap
 from cycler import cycler
 
@@ -83,3 +83,11 @@ tumcolor_cycler = (cycler(linewidth=[1, 2, 3, 4]) *
                                  'TUMRed', 'TUMDarkGreen'])
                   )
 
+
+# In[ ]:
+
+
+# colormap from white to TUMBlue, e.g. for density plots
+tumcolor_cmap = LinearSegmentedColormap.from_list('TUMBlues', [TUMCOLOR['TUMWhite'], TUMCOLOR['TUMBlue']])
+
+